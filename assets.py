@@ -0,0 +1,429 @@
+import atexit
+import buildcache
+import json
+import logging
+import minify
+import multiprocessing.pool
+import os
+import queue
+import re
+import settings
+import shutil
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+# Content hashed names of the media files, by their path relative to the media directory. Filled in by the build when it
+# hashes its assets (see hash_media), and used by url() so static() in templates refers to the hashed names.
+manifest = {}
+
+# Names of the js bundles split down to what a page needs, by page template and the name of the full bundle. Filled in by
+# the build when it splits its bundles, and used by page_bundle() so js_bundle() in templates refers to them.
+bundles = {}
+
+# @import statements of less files, e.g. @import "base/variables.less"; or @import (reference) '../mixins';
+LESS_IMPORT = re.compile(r'''@import\s*(?:\([^)]*\)\s*)?["']([^"']+)["']''')
+
+# Matches the content hashed names written by hash_media, including their precompressed siblings.
+HASHED_NAME = r'\.[0-9a-f]{{{0}}}\.[A-Za-z0-9]+(\.(gz|br))?$'.format(settings.ASSET_HASH_LENGTH)
+
+
+class MediaIndex(object):
+    """
+    The files and directories in the media directory, so the helpers can tell which images and stylesheets exist with a
+    set lookup instead of a stat for every image, platform and locale. The directory is listed on first use, and the
+    --watch observer keeps the index up to date as files are created, moved and deleted.
+    Parameters:
+        `root` (str): The media directory, paths are looked up relative to it.
+    """
+    def __init__(self, root):
+        self.root = root
+        self._files = None
+        self._directories = None
+
+    def _list(self):
+        if self._files is None:
+            self._files = set()
+            self._directories = set()
+            for dirpath, dirnames, filenames in os.walk(self.root, followlinks=True):
+                directory = os.path.relpath(dirpath, self.root)
+                self._directories.add(directory)
+                self._files.update(os.path.normpath(os.path.join(directory, name)) for name in filenames)
+
+    @property
+    def files(self):
+        """Set of the paths of the files, relative to `root`."""
+        self._list()
+        return self._files
+
+    def exists(self, path):
+        """Return whether there is a file or directory at `path` (relative to `root`)."""
+        self._list()
+        path = os.path.normpath(path)
+        return path in self._files or path in self._directories
+
+    def _relative(self, path):
+        path = os.path.relpath(os.path.abspath(path), os.path.abspath(self.root))
+        return None if path == os.pardir or path.startswith(os.pardir + os.sep) else path
+
+    def add(self, path):
+        """Add the file or directory at the filesystem `path`, if it's in `root`, along with whatever is in it."""
+        relative = self._relative(path)
+        if relative is None or self._files is None:
+            return
+        parent = os.path.dirname(relative)
+        while parent:
+            self._directories.add(parent)
+            parent = os.path.dirname(parent)
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path, followlinks=True):
+                directory = os.path.normpath(os.path.join(relative, os.path.relpath(dirpath, path)))
+                self._directories.add(directory)
+                self._files.update(os.path.join(directory, name) for name in filenames)
+        elif os.path.exists(path):
+            self._files.add(relative)
+
+    def discard(self, path):
+        """Remove the file or directory at the filesystem `path`, if it's in `root`, along with whatever was in it."""
+        relative = self._relative(path)
+        if relative is None or self._files is None:
+            return
+        prefix = relative + os.sep
+        self._files = {f for f in self._files if f != relative and not f.startswith(prefix)}
+        self._directories = {d for d in self._directories if d != relative and not d.startswith(prefix)}
+
+
+# Index of the media files the helpers refer to.
+media = MediaIndex(settings.MEDIA_URL.strip('/'))
+
+
+def url(filepath):
+    """Return the url of the media file `filepath`, under its content hashed name if it has one."""
+    return os.path.join(settings.MEDIA_URL, manifest.get(filepath, filepath))
+
+
+def page_bundle(template, name):
+    """Return the name of the js bundle `name` for the page rendered from `template`, the full bundle if it isn't split."""
+    return bundles.get(template, {}).get(name, name)
+
+
+def hashed_name(filepath, digest):
+    """Return `filepath` with the start of its content `digest` inserted before the extension, e.g. css/a.0123456789.css"""
+    name, ext = os.path.splitext(filepath)
+    return '{0}.{1}{2}'.format(name, digest[:settings.ASSET_HASH_LENGTH], ext)
+
+
+def hash_media(media, build_manifest=None, precompressed=()):
+    """
+    Give every file in the `media` directory a content hashed name, hardlinked next to the original, and return the
+    manifest of {path: hashed path}. The originals are kept, for references that don't go through static() like the
+    relative urls in css files. Files ending in one of the `precompressed` suffixes, the compressed siblings written by
+    --precompress, are skipped.
+    With a `build_manifest` the hashed names are recorded as outputs of the build, so the names of files that changed are
+    removed with the other stale outputs, along with the size and mtime of the file they were hashed from. A file whose
+    size and mtime didn't change since then keeps its hashed name without being read again.
+    """
+    previous = {}
+    if build_manifest is not None:
+        for key, inputs in build_manifest.outputs.items():
+            if inputs and 'media:source' in inputs:
+                previous[inputs['media:source'], inputs['media:stat']] = key
+
+    hashed = {}
+    stats = {}
+    for dirpath, dirnames, filenames in os.walk(media):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            filepath = os.path.relpath(path, media)
+            if filename in (settings.ASSET_MANIFEST, settings.BUNDLE_MANIFEST, '.htaccess') or re.search(HASHED_NAME, filename):
+                continue
+            if filename.endswith(tuple(precompressed)):
+                continue
+            stat = os.stat(path)
+            stats[filepath] = '{0}:{1}'.format(stat.st_size, stat.st_mtime_ns)
+            key = previous.get((filepath, stats[filepath]))
+            if key is not None and os.path.exists(os.path.join(build_manifest.root, key)):
+                hashed[filepath] = os.path.relpath(os.path.join(build_manifest.root, key), media)
+            else:
+                hashed[filepath] = hashed_name(filepath, buildcache.hash_file(path))
+
+    for filepath, hashed_path in hashed.items():
+        link = os.path.join(media, hashed_path)
+        try:
+            os.link(os.path.join(media, filepath), link)
+            created = True
+        except FileExistsError:
+            created = False
+        if build_manifest is not None:
+            build_manifest.produce(link, changed=created)
+            build_manifest.record(link, {'media:source': filepath, 'media:stat': stats[filepath]})
+    return hashed
+
+
+def load_manifest(media):
+    """Return the manifest written to the `media` directory by a previous build, or an empty one."""
+    try:
+        with open(os.path.join(media, settings.ASSET_MANIFEST), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def immutable_htaccess_rules():
+    """Return .htaccess rules that let browsers and CDNs cache the content hashed files forever."""
+    return ('<IfModule mod_headers.c>\n'
+            '<FilesMatch "{0}">\n'
+            'Header set Cache-Control "public, max-age={1}, immutable"\n'
+            '</FilesMatch>\n'
+            '</IfModule>\n').format(HASHED_NAME, settings.IMMUTABLE_MAX_AGE)
+
+
+class LessError(Exception):
+    """Raised when lessc fails to compile a less file."""
+
+
+class LessImportGraph(object):
+    """
+    The @import graph of the less files in `settings.ASSETS`, stored in `path` between builds.
+    A file's imports are only parsed again when its mtime changed, so resolving the graph is cheap in every build.
+    Parameters:
+        `path` (str): json file the graph is loaded from and saved to.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        try:
+            with open(path, 'r') as f:
+                self.files = json.load(f)
+        except (FileNotFoundError, ValueError):
+            pass
+
+    def imports(self, filepath):
+        """Return the less files (relative to `settings.ASSETS`) imported by `filepath`."""
+        source = os.path.join(settings.ASSETS, filepath)
+        mtime = os.stat(source).st_mtime_ns
+        entry = self.files.get(filepath)
+        if entry is None or entry['mtime'] != mtime:
+            with open(source, 'r', encoding='utf-8') as f:
+                content = f.read()
+            imports = []
+            for name in LESS_IMPORT.findall(content):
+                if not os.path.splitext(name)[1]:
+                    name += '.less'
+                if name.endswith('.less'):
+                    imports.append(os.path.normpath(os.path.join(os.path.dirname(filepath), name)))
+            entry = self.files[filepath] = {'mtime': mtime, 'imports': imports}
+        return entry['imports']
+
+    def closure(self, filepaths):
+        """Return the sorted list of `filepaths` and every less file they import, directly or not."""
+        seen = set()
+        pending = list(filepaths)
+        while pending:
+            filepath = pending.pop()
+            if filepath in seen or not os.path.exists(os.path.join(settings.ASSETS, filepath)):
+                continue
+            seen.add(filepath)
+            pending.extend(self.imports(filepath))
+        return sorted(seen)
+
+    def save(self):
+        """Write the graph to `path`."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump(self.files, f, sort_keys=True)
+
+
+def program_version(program):
+    """
+    Return a fingerprint of the installed `program`, such as lessc, so an upgrade doesn't reuse output cached from the
+    old one. Returns None if it isn't installed.
+    """
+    binary = shutil.which(program)
+    if binary is None:
+        return None
+    binary = os.path.realpath(binary)
+    return '{0}:{1}'.format(binary, os.stat(binary).st_mtime_ns)
+
+
+def less_module():
+    """Return the directory of the less node module that `settings.LESS_BIN` runs from, or None if it isn't found."""
+    binary = shutil.which(settings.LESS_BIN)
+    if binary is None:
+        return None
+    # npm installs lessc as a symlink to <node_modules>/less/bin/lessc
+    module = os.path.dirname(os.path.dirname(os.path.realpath(binary)))
+    if not os.path.exists(os.path.join(module, 'package.json')):
+        return None
+    return module
+
+
+class LessWorker(object):
+    """
+    A long-lived node process (`settings.LESS_WORKER`) that compiles less files, so node and less only start once
+    instead of once per file. Requests and responses are lines of json over its stdin and stdout. A worker that crashed
+    or was killed is restarted on the next compile.
+    Parameters:
+        `module` (str): Directory of the less node module the worker loads.
+    """
+    def __init__(self, module):
+        self.module = module
+        self.proc = None
+
+    def start(self):
+        self.proc = subprocess.Popen([settings.NODE_BIN, settings.LESS_WORKER, self.module], stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, encoding='utf-8')
+
+    def _request(self, source):
+        if self.proc is None or self.proc.poll() is not None:
+            self.start()
+        self.proc.stdin.write(json.dumps({'filename': os.path.abspath(source)}) + '\n')
+        self.proc.stdin.flush()
+        line = self.proc.stdout.readline()
+        if not line:
+            raise BrokenPipeError('less worker exited')
+        return json.loads(line)
+
+    def compile(self, source):
+        """
+        Compile the less file `source` and return the css. Raises LessError if it doesn't compile, or OSError if the
+        worker doesn't work, even after being restarted.
+        """
+        try:
+            response = self._request(source)
+        except (OSError, ValueError):
+            self.close()
+            response = self._request(source)
+        if 'error' in response:
+            raise LessError('{0}: {1}'.format(source, response['error']))
+        return response['css']
+
+    def close(self):
+        if self.proc is not None:
+            self.proc.kill()
+            self.proc.wait()
+            self.proc = None
+
+
+# Idle workers, one is started for each thread compiling at the same time.
+_less_workers = queue.SimpleQueue()
+
+# Set once a worker fails to start, from then on the build falls back to running lessc for every file.
+_less_worker_failed = False
+
+
+def _close_less_workers():
+    while not _less_workers.empty():
+        _less_workers.get().close()
+
+
+atexit.register(_close_less_workers)
+
+
+def _compile_with_worker(source):
+    global _less_worker_failed
+    try:
+        worker = _less_workers.get_nowait()
+    except queue.Empty:
+        worker = LessWorker(less_module())
+    try:
+        css = worker.compile(source)
+    except OSError as err:
+        logger.warning("The less worker failed, compiling with {0} instead: {1}".format(settings.LESS_BIN, err))
+        worker.close()
+        _less_worker_failed = True
+        _close_less_workers()
+        return None
+    except LessError:
+        _less_workers.put(worker)
+        raise
+    _less_workers.put(worker)
+    return css
+
+
+def compile_less(filepath):
+    """
+    Compile the less file `filepath` (relative to `settings.ASSETS`) and return the css. This uses a long-lived
+    LessWorker when `settings.LESS_WORKER` is set and the less module is found, otherwise it runs lessc.
+    """
+    source = os.path.join(settings.ASSETS, filepath)
+    if settings.LESS_WORKER and not _less_worker_failed and less_module():
+        css = _compile_with_worker(source)
+        if css is not None:
+            return css
+    return run_lessc(filepath)
+
+
+def run_lessc(filepath):
+    """Compile the less file `filepath` (relative to `settings.ASSETS`) with a new lessc process and return the css."""
+    source = os.path.join(settings.ASSETS, filepath)
+    with open(source, 'rb') as f:
+        data = f.read()
+    try:
+        # Run in the directory of the file, so its imports are found.
+        proc = subprocess.run([settings.LESS_BIN, '-'], input=data, capture_output=True, cwd=os.path.dirname(source))
+    except OSError:
+        raise LessError('Program file not found: {0}.'.format(settings.LESS_BIN))
+    if proc.returncode:
+        raise LessError('{0}: {1}'.format(filepath, proc.stderr.decode('utf-8').strip()))
+    return proc.stdout.decode('utf-8')
+
+
+def build_less_bundle(filepaths, graph, cache):
+    """
+    Return the css of the bundle of less files `filepaths`, and whether it had to be compiled.
+    The css is cached in `cache` under the hash of every file in the bundle's import `graph`, so a bundle is only
+    compiled again when one of the files it (transitively) imports changes.
+    """
+    key = buildcache.fingerprint({
+        'bundle': filepaths,
+        'files': {f: buildcache.hash_file(os.path.join(settings.ASSETS, f)) for f in graph.closure(filepaths)},
+        'lessc': program_version(settings.LESS_BIN),
+    })
+    css = cache.get(key)
+    if css is not None:
+        return css, False
+    css = '\n'.join(compile_less(filepath) for filepath in filepaths)
+    cache.set(key, css)
+    return css, True
+
+
+def build_js_bundle(filepaths, cache, terser=None):
+    """
+    Return the js of the bundle of `filepaths` and its source map (dict). The bundle is minified with `terser`, the
+    program_version of the installed terser, or if that's None not minified and without a source map.
+    The files are minified separately and cached in `cache` under their content hash, so changing a file only minifies
+    that file again. The source map is an index map with a section for each minified file. Files named *.min.js are
+    already minified, and included as they are.
+    """
+    if terser is None:
+        sources = []
+        for filepath in filepaths:
+            with open(os.path.join(settings.ASSETS, filepath), 'r', encoding='utf-8') as f:
+                sources.append(f.read())
+        return '\n'.join(sources), None
+
+    def minify_file(filepath):
+        path = os.path.join(settings.ASSETS, filepath)
+        if filepath.endswith('.min.js'):
+            with open(path, 'r', encoding='utf-8') as f:
+                return f.read(), None
+        key = buildcache.fingerprint({'file': filepath, 'source': buildcache.hash_file(path), 'terser': terser})
+        cached = cache.get(key)
+        if cached is not None:
+            cached = json.loads(cached)
+            return cached['code'], cached['map']
+        code, source_map = minify.minify_js(filepath)
+        cache.set(key, json.dumps({'code': code, 'map': source_map}))
+        return code, source_map
+
+    with multiprocessing.pool.ThreadPool(min(len(filepaths), os.cpu_count()) or 1) as pool:
+        results = pool.map(minify_file, filepaths)
+
+    sections = []
+    line = 0
+    for code, source_map in results:
+        if source_map is not None:
+            sections.append({'offset': {'line': line, 'column': 0}, 'map': source_map})
+        line += code.count('\n') + 1
+    return '\n'.join(code for code, source_map in results), {'version': 3, 'sections': sections}
@@ -4,13 +4,12 @@ import sys
 import build_calendar
 import os.path
 
+import buildcache
 import builder
 import feedparser
 import helper
 import settings
 
-from datetime import date
-
 from calgen.providers.CalendarificProvider import CalendarificProvider
 
 parser = argparse.ArgumentParser()
@@ -25,9 +24,50 @@ parser.add_argument('--watch', help='Rebuild when template and asset dirs are ch
                     action='store_true')
 parser.add_argument('--port', const=8000, default=8000, type=int,
                     help='Port for the server that runs with --watch.', nargs='?')
+parser.add_argument('--jobs', const=os.cpu_count(), default=1, type=int, nargs='?',
+                    help='Render locales in parallel using this many processes. Defaults to the number of CPUs if no value is given.')
+parser.add_argument('--incremental', help='Only render pages whose templates, translations or data changed since the last build.',
+                    action='store_true')
+parser.add_argument('--minify', action='store_true',
+                    help='Minify the rendered html pages, keeping pre, script, style and inline svg contents as they are, and the js bundles.')
+parser.add_argument('--hash-assets', action='store_true',
+                    help='Give the media files content hashed names, so they can be cached forever, and refer to those in the pages.')
+parser.add_argument('--split-bundles', action='store_true',
+                    help='Give every page js bundles of only the files it needs, and write a manifest of the bundles each page uses.')
+parser.add_argument('--prune-css', action='store_true',
+                    help='Remove the css rules that match nothing in the rendered pages from the css bundles, and report the bytes removed.')
+parser.add_argument('--critical-css', action='store_true',
+                    help='Inline the css the landing pages need to render above the fold, and load the rest without blocking.')
+parser.add_argument('--optimize-svg', action='store_true',
+                    help='Strip metadata, comments and whitespace from the inlined svg files and round their paths, '
+                         'and report the bytes of svg in the pages.')
+parser.add_argument('--svg-symbols', action='store_true',
+                    help='Inline the contents of an svg file used more than once on a page only once, as a <symbol>.')
+parser.add_argument('--link-media', action='store_true',
+                    help='Hardlink the media files into the output directory instead of copying them.')
+parser.add_argument('--precompress', action='store_true',
+                    help='Write gzip (and brotli) compressed copies of the text files next to them, with the .htaccess rules to serve them.')
+parser.add_argument('--reproducible', action='store_true',
+                    help='Take all timestamps in the output from SOURCE_DATE_EPOCH, or if unset the newest commit of the inputs.')
+parser.add_argument('--trace', metavar='FILE',
+                    help='Write how long each step of the build took to FILE in the Chrome trace event format, '
+                         'and print the slowest templates and locales.')
+parser.add_argument('--profile-helpers', metavar='FILE', nargs='?', const=True,
+                    help='Count the calls to the template helpers and filters and the time spent in them by template and locale, '
+                         'print the ones that took the longest, and write all of them to FILE as json if given.')
 parser.add_argument('--devmode', help='Enables various behaviours that would be helpful for development. (e.g. not hard crashing on jinja syntax errors.)', action='store_true')
 args = parser.parse_args()
 
+if args.prune_css and args.hash_assets:
+    # The bundles are pruned after the pages referring to their hashed names are rendered.
+    parser.error("--prune-css can't be combined with --hash-assets.")
+
+if args.reproducible and not os.environ.get('SOURCE_DATE_EPOCH'):
+    epoch = buildcache.source_date_epoch()
+    if epoch is None:
+        sys.exit("--reproducible needs SOURCE_DATE_EPOCH to be set, or the inputs to be git checkouts.")
+    os.environ['SOURCE_DATE_EPOCH'] = str(epoch)
+
 if args.enus:
     langmsg = 'in en-US only.'
     languages = ['en-US']
@@ -39,7 +79,12 @@ else:
 
 if args.startpage:
     print('Rendering start page ' + langmsg)
-    site = builder.Site(languages, settings.START_PATH, settings.START_RENDERPATH, settings.START_CSS, debug=args.debug, dev_mode=args.devmode)
+    site = builder.Site(languages, settings.START_PATH, settings.START_RENDERPATH, settings.START_CSS, debug=args.debug, dev_mode=args.devmode,
+                        incremental=args.incremental, precompress=args.precompress,
+                        minify=args.minify, hash_assets=args.hash_assets, link_media=args.link_media,
+                        split_bundles=args.split_bundles, prune_css=args.prune_css, critical_css=args.critical_css,
+                        optimize_svg=args.optimize_svg, svg_symbols=args.svg_symbols,
+                        trace=args.trace, profile_helpers=args.profile_helpers)
     site.build_startpage()
 elif args.buildcalendars:
     print("Building calendar files")
@@ -65,7 +110,10 @@ else:
     else:
         caldata = helper.load_calendar_json('media/caldata/calendars.json')
 
-    context = {'current_year': date.today().year,
+    # Only keep the feed entries, the rest of the response (headers, etag, ...) changes on every request.
+    blog_feed = feedparser.parse(settings.BLOG_FEED_URL)
+
+    context = {'current_year': buildcache.build_time().year,
                'platform': 'desktop',
                'query': '',
                'platforms': helper.thunderbird_desktop.platforms('release'),
@@ -79,11 +127,16 @@ else:
                'CALDATA_URL': settings.CALDATA_URL,
                'latest_thunderbird_version': version,
                'latest_thunderbird_beta_version': beta_version,
-               'blog_data': feedparser.parse(settings.BLOG_FEED_URL)
+               'blog_data': {'entries': blog_feed.entries}
                }
 
     site = builder.Site(languages, settings.WEBSITE_PATH, settings.WEBSITE_RENDERPATH,
-                        settings.WEBSITE_CSS, js_bundles=settings.WEBSITE_JS, data=context, debug=args.debug, dev_mode=args.devmode)
+                        settings.WEBSITE_CSS, js_bundles=settings.WEBSITE_JS, data=context, debug=args.debug, dev_mode=args.devmode, jobs=args.jobs,
+                        incremental=args.incremental, precompress=args.precompress,
+                        minify=args.minify, hash_assets=args.hash_assets, link_media=args.link_media,
+                        split_bundles=args.split_bundles, prune_css=args.prune_css, critical_css=args.critical_css,
+                        optimize_svg=args.optimize_svg, svg_symbols=args.svg_symbols,
+                        trace=args.trace, profile_helpers=args.profile_helpers)
     site.build_website()
 
 if args.watch:
@@ -1,12 +1,13 @@
 #!/usr/bin/python
 import json
 import sys
-from datetime import datetime, UTC
+from datetime import datetime
 import os
 import time
 import icalendar
 import requests
 
+import buildcache
 import helper
 import settings
 
@@ -77,7 +78,7 @@ def build_calendars(provider: Provider, locales: dict):
 
     calendar_metadata = []
 
-    now_utc = datetime.now(UTC)
+    now_utc = buildcache.build_time()
 
     # Check if the folders exist
     if not os.path.exists(settings.CALDATA_AUTOGEN_URL):
@@ -0,0 +1,334 @@
+import ctypes
+import datetime
+import hashlib
+import jinja2
+import json
+import os
+import settings
+import subprocess
+import tempfile
+
+
+def hash_bytes(data):
+    """Return the sha256 hex digest of `data` (bytes or str)."""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_file(path):
+    """Return the sha256 hex digest of the file at `path`, or None if it doesn't exist."""
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+    except (FileNotFoundError, IsADirectoryError):
+        return None
+    return digest.hexdigest()
+
+
+def fingerprint(value):
+    """Return a stable hash of a json-like `value`, such as the data dict passed into the Jinja2 global context."""
+    return hash_bytes(json.dumps(value, sort_keys=True, default=str))
+
+
+def source_date_epoch():
+    """
+    Return the newest commit time (unix timestamp) of the git checkouts in `settings.SOURCE_DATE_PATHS`, or None if none
+    of them are git checkouts.
+    """
+    timestamps = []
+    for path in settings.SOURCE_DATE_PATHS:
+        try:
+            output = subprocess.run(['git', 'log', '-1', '--format=%ct', '--', '.'], cwd=path, capture_output=True,
+                                    text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            continue
+        if output:
+            timestamps.append(int(output))
+    return max(timestamps, default=None)
+
+
+_build_time = None
+
+
+def build_time():
+    """
+    Return the time (UTC, without microseconds) used for every timestamp in the build output, such as NOW in templates.
+    It's taken from the SOURCE_DATE_EPOCH environment variable if set, so identical inputs produce identical output,
+    and is otherwise the time it's first asked for. Either way it's the same for the whole build.
+    """
+    global _build_time
+    if _build_time is None:
+        epoch = os.environ.get('SOURCE_DATE_EPOCH')
+        if epoch:
+            _build_time = datetime.datetime.fromtimestamp(int(epoch), datetime.UTC)
+        else:
+            _build_time = datetime.datetime.now(datetime.UTC).replace(microsecond=0)
+    return _build_time
+
+
+def _exchange(a, b):
+    """Swap the paths `a` and `b` in one step with renameat2(RENAME_EXCHANGE). Returns False where that isn't available."""
+    renameat2 = getattr(ctypes.CDLL(None, use_errno=True), 'renameat2', None)
+    if renameat2 is None:
+        return False
+    # AT_FDCWD, RENAME_EXCHANGE
+    return renameat2(-100, os.fsencode(a), -100, os.fsencode(b), 2) == 0
+
+
+def publish(build, live):
+    """
+    Make `live` a symlink to the directory `build` and return the directory it pointed to before, or None.
+    The new symlink is made next to `live` and renamed over it, so `live` is always either the previous build or the new
+    one, never missing. A directory at `live` (from before builds were published through a symlink) is swapped with the
+    symlink in one step where the platform allows it, and otherwise moved aside just before the symlink replaces it.
+    """
+    live = os.path.normpath(live)
+    link = live + '.link'
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.relpath(build, os.path.dirname(live) or os.curdir), link)
+    if os.path.islink(live) or not os.path.exists(live):
+        previous = os.path.realpath(live) if os.path.islink(live) else None
+        os.replace(link, live)
+        return previous
+    if _exchange(link, live):
+        return link
+    previous = live + '.old'
+    os.rename(live, previous)
+    os.replace(link, live)
+    return previous
+
+
+class BuildManifest(object):
+    """
+    Persistent record of what every output file was built from.
+    For each output (relative to `root`) we store a dict of its inputs, keyed by a name such as `template:index.html`,
+    mapped to that input's content hash. If the inputs of an output haven't changed since it was recorded, and the output
+    still exists, it doesn't need to be rendered again. Outputs that are always written, like .htaccess files, are
+    stored without inputs, so we still know which outputs a build produced.
+    During a build we also keep track of which outputs actually changed, for the report of changed files.
+    Parameters:
+        `path` (str): json file the manifest is loaded from and saved to.
+        `root` (str): Directory the output paths are relative to.
+    """
+    def __init__(self, path, root):
+        self.path = path
+        self.root = root
+        self.outputs = {}
+        self.records = {}
+        self.changed = set()
+        self.removed = set()
+        self._hashes = {}
+        try:
+            with open(path, 'r') as f:
+                self.outputs = json.load(f).get('outputs', {})
+        except (FileNotFoundError, ValueError):
+            pass
+
+    def begin(self):
+        """Start a new build, forgetting the file hashes memoized during the previous one."""
+        self._hashes = {}
+
+    def file_hash(self, path):
+        """Memoized `hash_file`, input files are only read once per build."""
+        if path not in self._hashes:
+            self._hashes[path] = hash_file(path)
+        return self._hashes[path]
+
+    def _key(self, output):
+        return os.path.relpath(output, self.root)
+
+    def is_fresh(self, output, inputs):
+        """Return whether `output` exists and was last built from exactly `inputs`. Fresh outputs are kept in the manifest."""
+        key = self._key(output)
+        if self.records.get(key, self.outputs.get(key)) != inputs or not os.path.exists(output):
+            return False
+        self.records[key] = inputs
+        return True
+
+    def record(self, output, inputs):
+        """Record that `output` was built from `inputs` during this build."""
+        self.records[self._key(output)] = inputs
+
+    def produce(self, output, changed=True):
+        """Record that `output` was produced during this build, without tracking its inputs, and whether it `changed`."""
+        key = self._key(output)
+        self.records.setdefault(key, None)
+        if changed:
+            self.changed.add(key)
+
+    def remove(self, output):
+        """Forget `output`, which was removed during this build."""
+        key = self._key(output)
+        self.outputs.pop(key, None)
+        self.records.pop(key, None)
+        self.changed.discard(key)
+        self.removed.add(key)
+
+    def stale(self):
+        """Return the outputs of the previous build that weren't produced by this build."""
+        return sorted(set(self.outputs) - set(self.records))
+
+    def changes(self, full=False):
+        """
+        Return the outputs that were added, changed and removed by this build, compared to the previous one.
+        Only a `full` build removes the outputs it didn't produce, other builds only those removed explicitly.
+        """
+        removed = set(self.stale()) if full else set()
+        return {
+            'added': sorted(key for key in self.changed if key not in self.outputs),
+            'changed': sorted(key for key in self.changed if key in self.outputs),
+            'removed': sorted(removed | self.removed),
+        }
+
+    def pop_records(self):
+        """Return and clear the records and changed outputs of this build, used to collect them from worker processes."""
+        records, self.records = self.records, {}
+        changed, self.changed = self.changed, set()
+        return records, changed
+
+    def update(self, records, changed=()):
+        """Merge `records` and `changed` outputs collected elsewhere (e.g. a worker process) into this build."""
+        self.records.update(records)
+        self.changed.update(changed)
+
+    def save(self, full=False):
+        """
+        Merge this build's records into the manifest and write it to `path`.
+        After a `full` build the manifest is replaced instead, dropping the stale outputs.
+        """
+        if full:
+            self.outputs = {}
+        self.removed = set()
+        records, changed = self.pop_records()
+        self.outputs.update(records)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump({'outputs': self.outputs}, f, sort_keys=True)
+
+
+def evict_lru(directory, suffix, max_size):
+    """
+    Delete the least recently used (by mtime) files ending in `suffix` from `directory` until they fit in `max_size`
+    bytes.
+    """
+    entries = []
+    for filename in os.listdir(directory):
+        if not filename.endswith(suffix):
+            continue
+        try:
+            stat = os.stat(os.path.join(directory, filename))
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, filename))
+
+    total = sum(size for mtime, size, filename in entries)
+    for mtime, size, filename in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(os.path.join(directory, filename))
+        except OSError:
+            # Another process may have evicted it already.
+            pass
+        total -= size
+
+
+class FileCache(object):
+    """
+    On-disk cache of build artifacts, like compiled css, stored under a hash of everything they were built from.
+    With a `max_size` the least recently used artifacts are evicted once the cache grows over it.
+    Parameters:
+        `directory` (str): Directory the artifacts are stored in.
+        `suffix` (str, optional): Extension of the stored files.
+        `max_size` (int, optional): Size cap of the cache in bytes.
+    """
+    def __init__(self, directory, suffix='', max_size=None):
+        self.directory = directory
+        self.suffix = suffix
+        self.max_size = max_size
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get(self, key):
+        """Return the artifact stored under `key`, or None."""
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        if self.max_size is not None:
+            # Bump the mtime, it's what eviction uses to find the least recently used entries.
+            try:
+                os.utime(self._path(key))
+            except OSError:
+                pass
+        return data
+
+    def set(self, key, data):
+        """Store the artifact `data` (str) under `key`. It's replaced atomically, other processes may read it meanwhile."""
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp, self._path(key))
+        if self.max_size is not None:
+            self.evict()
+
+    def evict(self):
+        """Delete the least recently used artifacts until the cache fits in `max_size`."""
+        evict_lru(self.directory, self.suffix, self.max_size)
+
+
+class BytecodeCache(jinja2.FileSystemBytecodeCache):
+    """
+    On-disk Jinja2 bytecode cache shared by every environment, build and worker process.
+    Entries are keyed by the template's name, filename and source hash, plus the Jinja2 version, so a changed template or
+    Jinja2 upgrade never loads stale bytecode. Once the cache grows over `max_size` bytes the least recently used entries
+    are evicted.
+    Parameters:
+        `directory` (str): Directory the bytecode is stored in.
+        `max_size` (int): Size cap of the cache in bytes.
+    """
+    def __init__(self, directory, max_size):
+        os.makedirs(directory, exist_ok=True)
+        super(BytecodeCache, self).__init__(directory, '%s.cache')
+        self.max_size = max_size
+
+    def get_bucket(self, environment, name, filename, source):
+        key = hash_bytes('\0'.join((jinja2.__version__, name, filename or '', source)))
+        bucket = jinja2.bccache.Bucket(environment, key, self.get_source_checksum(source))
+        self.load_bytecode(bucket)
+        return bucket
+
+    def load_bytecode(self, bucket):
+        super(BytecodeCache, self).load_bytecode(bucket)
+        if bucket.code is not None:
+            # Bump the mtime, it's what eviction uses to find the least recently used entries.
+            try:
+                os.utime(self._get_cache_filename(bucket))
+            except OSError:
+                pass
+
+    def dump_bytecode(self, bucket):
+        super(BytecodeCache, self).dump_bytecode(bucket)
+        self.evict()
+
+    def evict(self):
+        """Delete the least recently used entries until the cache fits in `max_size`."""
+        evict_lru(self.directory, '.cache', self.max_size)
+
+
+_bytecode_cache = None
+
+
+def bytecode_cache():
+    """Return the bytecode cache shared by all Jinja2 environments in this process."""
+    global _bytecode_cache
+    if _bytecode_cache is None:
+        _bytecode_cache = BytecodeCache(os.path.join(settings.BUILD_CACHE_PATH, 'jinja'), settings.BYTECODE_CACHE_MAX_SIZE)
+    return _bytecode_cache
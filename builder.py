@@ -1,22 +1,36 @@
+import assets
 import datetime
 import errno
+import fnmatch
+import glob
+import gzip
 
 import jinja2.exceptions
+import jinja2.meta
+import jinja2.nodes
 import markdown
 import markupsafe
+import minify
+import profiling
+import redirectmap
 import requests
 
+import buildcache
 import helper
+import json
 import logging
 import multiprocessing
-import ntpath
+import multiprocessing.pool
 import os
 import shutil
 import settings
+import stylesheets
+import svgstore
 import sys
+import tempfile
 import time
+import tracing
 import translate
-import webassets
 
 from socketserver import TCPServer
 import http.server
@@ -34,13 +48,44 @@ from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 import urllib.parse
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 extensions = ['jinja2.ext.i18n']
 
+# Source files that can change the output of any page, relative to this file.
+CODE_INPUTS = ('builder.py', 'helper.py', 'translate.py', 'settings.py', 'product_details.py', 'minify.py', 'assets.py',
+               'stylesheets.py', 'svgstore.py')
+
+# Helpers that read from the media directory while rendering, mapped to the build input they depend on.
+MEDIA_HELPERS = {
+    'svg': 'media:svg',
+    'high_res_img': 'media:files',
+    'l10n_img': 'media:files',
+    'platform_img': 'media:files',
+    'l10n_css': 'media:files',
+}
+
+# The pages rendered for each release note, as (template, output directory) pairs.
+NOTE_PAGES = (
+    ('includes/_enonly/release-notes.html', 'releasenotes'),
+    ('includes/_enonly/system_requirements.html', 'system-requirements'),
+)
+
+# Rendered by helper.download_thunderbird in its own environment, so it isn't referenced by the calling template.
+DOWNLOAD_BUTTON_TEMPLATE = 'includes/download-button.html'
+
 # Logging default off unless debug = True.
 logger = logging.getLogger(__name__)
 sh = logging.StreamHandler(sys.stdout)
 logger.addHandler(sh)
 
+# Files written with write_file get the same permissions open() would have given them.
+UMASK = os.umask(0)
+os.umask(UMASK)
+
 
 def read_file(file):
     """Read `file` and return contents."""
@@ -57,43 +102,211 @@ def mkdir(path):
             raise
 
 
-def write_site_htaccess(renderpath: str, lang: str, redirects: dict):
-    """Writes .htaccess files from a given redirects dictionary for the given language."""
+def write_file(path, content, manifest=None):
+    """
+    Write `content` (str or bytes) to `path`, creating any needed directories. Returns whether the file was written.
+    If `path` already holds exactly `content` it's left alone, so unchanged outputs keep their mtime and don't show up as
+    changes. Otherwise the file is replaced rather than rewritten, so nobody ever reads a half written file, and a file
+    that is hardlinked into a staging directory is never modified in place.
+    If a `manifest` is given the file is recorded as an output of this build, and as changed if it was written.
+    """
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    try:
+        if os.path.getsize(path) == len(content):
+            with open(path, 'rb') as f:
+                unchanged = f.read() == content
+        else:
+            unchanged = False
+    except OSError:
+        unchanged = False
+    if manifest is not None:
+        manifest.produce(path, changed=not unchanged)
+    if unchanged:
+        return False
+
+    dirpath = os.path.dirname(path)
+    os.makedirs(dirpath, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=dirpath, prefix='.' + os.path.basename(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.chmod(tmp, 0o666 & ~UMASK)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    return True
+
+
+def copy_file(source, dest, link=False):
+    """
+    Copy the file at `source` to `dest`, with its mode and mtime, or if `link` is set hardlink it if possible.
+    Like with write_file, `dest` is replaced rather than rewritten.
+    """
+    dirpath = os.path.dirname(dest)
+    os.makedirs(dirpath, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=dirpath, prefix='.' + os.path.basename(dest), suffix='.tmp')
+    os.close(fd)
+    try:
+        linked = False
+        if link:
+            os.remove(tmp)
+            try:
+                os.link(source, tmp)
+                linked = True
+            except OSError:
+                # e.g. the source is on another filesystem.
+                pass
+        if not linked:
+            shutil.copy2(source, tmp)
+        os.replace(tmp, dest)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def write_site_htaccess(renderpath: str, lang: str, redirects: dict, manifest=None, redirect_map=None):
+    """Writes .htaccess files from a given redirects dictionary for the given language, and adds them to `redirect_map`."""
     for path, url_key in redirects.items():
         # Normalize non-tuples
         if type(path) is not tuple:
             path = (path,)
         path = os.path.join(renderpath, lang, *path)
         redirect_path = helper.url({'LANG': lang}, url_key)
-        write_htaccess(path, redirect_path)
+        write_htaccess(path, redirect_path, manifest, redirect_map)
 
 
-def write_htaccess_custom(path, rules: str):
+def write_htaccess_custom(path, rules: str, manifest=None):
     """Write an .htaccess to `path` that rewrites based on custom rules"""
-    os.makedirs(path, exist_ok=True)
-    with open(os.path.join(path, '.htaccess'), 'w') as f:
-        f.write(rules)
+    write_file(os.path.join(path, '.htaccess'), rules, manifest)
 
 
-def write_htaccess(path, url):
-    """Write an .htaccess to `path` that rewrites everything to `url`."""
-    write_htaccess_custom(path, 'RewriteEngine On\nRewriteRule .* {url}\n'.format(url=url))
+def write_htaccess(path, url, manifest=None, redirect_map=None):
+    """Write an .htaccess to `path` that rewrites everything to `url`, and add the redirect to `redirect_map` if given."""
+    if redirect_map is not None:
+        redirect_map.redirect(path, url)
+    write_htaccess_custom(path, 'RewriteEngine On\nRewriteRule .* {url}\n'.format(url=url), manifest)
 
 
-def write_404_htaccess(path, lang):
-    """Write an .htaccess to `path` that points to 404.html for locale `lang`."""
-    write_htaccess_custom(path, 'ErrorDocument 404 /{lang}/404.html\n'.format(lang=lang))
+def write_404_htaccess(path, lang, manifest=None, rules='', redirect_map=None):
+    """
+    Write an .htaccess to `path` that points to 404.html for locale `lang`, followed by any other `rules`, and add the
+    404 page to `redirect_map` if given.
+    """
+    if redirect_map is not None:
+        redirect_map.error_page(path, '/{lang}/404.html'.format(lang=lang))
+    write_htaccess_custom(path, 'ErrorDocument 404 /{lang}/404.html\n'.format(lang=lang) + rules, manifest)
 
 
-def delete_contents(dirpath):
-    """Delete all contents of `dirpath` except the root dir. Workaround for shutil.rmtree."""
-    if os.path.exists(dirpath):
-        for filename in os.listdir(dirpath):
-            filepath = os.path.join(dirpath, filename)
-            try:
-                shutil.rmtree(filepath)
-            except OSError:
-                os.remove(filepath)
+def _gzip(data):
+    # No mtime in the header, so identical files compress to identical bytes.
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+# Precompressed siblings we write: (suffix, Content-Encoding, compress function). Brotli is optional.
+PRECOMPRESSORS = [('.gz', 'gzip', _gzip)]
+if brotli is not None:
+    PRECOMPRESSORS.append(('.br', 'br', brotli.compress))
+
+
+def is_precompressible(path):
+    """Return whether `path` is a text output that should get precompressed siblings."""
+    return os.path.splitext(path)[1] in settings.PRECOMPRESS_TYPES and os.path.getsize(path) >= settings.PRECOMPRESS_MIN_SIZE
+
+
+def precompress_file(path):
+    """
+    Write the precompressed siblings (e.g. index.html.gz) of the file at `path`, unless they're already newer than it.
+    Returns a list of (sibling, changed) tuples.
+    """
+    mtime = os.stat(path).st_mtime
+    data = None
+    siblings = []
+    for suffix, encoding, compress in PRECOMPRESSORS:
+        sibling = path + suffix
+        try:
+            fresh = os.stat(sibling).st_mtime >= mtime
+        except OSError:
+            fresh = False
+        if fresh:
+            siblings.append((sibling, False))
+            continue
+        if data is None:
+            with open(path, 'rb') as f:
+                data = f.read()
+        changed = write_file(sibling, compress(data))
+        if not changed:
+            # Same contents (e.g. the file was copied again), mark the sibling as up to date for the next build.
+            os.utime(sibling)
+        siblings.append((sibling, changed))
+    return siblings
+
+
+def precompress_htaccess_rules():
+    """Return .htaccess rules that serve the precompressed siblings of text outputs to clients that accept them."""
+    extensions = '|'.join(ext.lstrip('.') for ext in settings.PRECOMPRESS_TYPES)
+    rules = ['<IfModule mod_headers.c>', 'RewriteEngine On']
+    for suffix, encoding, compress in PRECOMPRESSORS:
+        rules += ['RewriteCond %{{HTTP:Accept-Encoding}} \\b{0}\\b'.format(encoding),
+                  'RewriteCond %{{REQUEST_FILENAME}}{0} -s'.format(suffix),
+                  'RewriteRule ^(.+\\.({0}))$ $1{1} [L]'.format(extensions, suffix)]
+    for ext, content_type in settings.PRECOMPRESS_TYPES.items():
+        for suffix, encoding, compress in PRECOMPRESSORS:
+            # Keep the type of the original file, and don't let mod_deflate compress it again.
+            rules.append('RewriteRule \\{0}\\{1}$ - [T={2},E=no-gzip:1,E=no-brotli:1]'.format(ext, suffix, content_type))
+    for suffix, encoding, compress in PRECOMPRESSORS:
+        rules += ['<FilesMatch "\\.({0})\\{1}$">'.format(extensions, suffix),
+                  'Header set Content-Encoding {0}'.format(encoding),
+                  'Header append Vary Accept-Encoding',
+                  '</FilesMatch>']
+    rules.append('</IfModule>')
+    return '\n'.join(rules) + '\n'
+
+
+def remove_output(path, root):
+    """Remove the file at `path`, and any directories up to `root` that are left empty."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    dirpath = os.path.dirname(path)
+    while os.path.abspath(dirpath) != os.path.abspath(root):
+        try:
+            os.rmdir(dirpath)
+        except OSError:
+            break
+        dirpath = os.path.dirname(dirpath)
+
+
+def is_page(template):
+    """Return whether `template` is a renderable page. Non-html files, or any path that starts with `_` or `includes` are not."""
+    return template.endswith('.html') and not template.startswith('_') and not template.startswith('includes')
+
+
+class TemplateIndex(object):
+    """
+    Index of the renderable pages of a Jinja2 environment.
+    Listing the templates walks the whole search path, so it's done once and kept until `invalidate` is called, which the
+    --watch observer does when files are created or deleted.
+    Parameters:
+        `env` (jinja2.Environment): Environment whose loader is listed.
+    """
+    def __init__(self, env):
+        self._env = env
+        self._pages = None
+
+    @property
+    def pages(self):
+        """Sorted list of the renderable page templates."""
+        if self._pages is None:
+            self._pages = self._env.list_templates(filter_func=is_page)
+        return self._pages
+
+    def invalidate(self):
+        """Forget the listed pages, they are listed again the next time they're needed."""
+        self._pages = None
 
 
 class Legal:
@@ -132,27 +345,93 @@ class Site(object):
         `data` (dict, optional): dict to be directly added to the Jinja2 global context.
         `debug` (bool, optional): Optionally write log output or not.
         `dev_mode` (bool, optional): Enables various behaviours that would be helpful for develoeprs. Don't use on prod.
+        `jobs` (int, optional): Number of worker processes used to render locales in parallel. Defaults to 1 (serial).
+        `incremental` (bool, optional): Only render outputs whose inputs changed since they were recorded in the build manifest.
+        `precompress` (bool, optional): Write gzip (and brotli) compressed siblings of the text outputs after the build.
+        `minify` (bool, optional): Minify the rendered html pages before they're written.
+        `hash_assets` (bool, optional): Give the media files content hashed names, which static() refers to.
+        `link_media` (bool, optional): Hardlink the media files into `renderpath` instead of copying them.
+        `split_bundles` (bool, optional): Give every page js bundles of only the files it needs, see _split_js.
+        `prune_css` (bool, optional): Remove the css rules that match nothing in the rendered pages from the css bundles.
+        `critical_css` (bool, optional): Inline the css the `settings.CRITICAL_CSS_PAGES` need above the fold.
+        `optimize_svg` (bool, optional): Optimize the svg files inlined by helper.svg, see svgstore.optimize_svg.
+        `svg_symbols` (bool, optional): Inline the svg files a page uses more than once as a <symbol>, see svgstore.SvgStore.end_page.
+        `trace` (str, optional): Write the spans of every build to this json file in the Chrome trace event format, and
+            print the templates and locales that took the longest.
+        `profile_helpers` (bool or str, optional): Count the calls to the template helpers and filters and the time spent
+            in them, and print the ones that took the longest. If it's a path, every count is also written there as json.
     Attributes:
         `lang`: Current language to build the site in, an element of `languages`.
     """
-    def __init__(self, languages, searchpath, renderpath, css_bundles, staticdir='_media', js_bundles={}, data={}, debug=False, dev_mode=False):
+    def __init__(self, languages, searchpath, renderpath, css_bundles, staticdir='_media', js_bundles={}, data={}, debug=False, dev_mode=False,
+                 jobs=1, incremental=False, precompress=False, minify=False,
+                 hash_assets=False, link_media=False, split_bundles=False,
+                 prune_css=False, critical_css=False, optimize_svg=False, svg_symbols=False, trace=None, profile_helpers=None):
         self.languages = languages
         self.lang = languages[0]
         self.context = {}
         self.searchpath = searchpath
         self.renderpath = renderpath
         self.staticpath = os.path.join(searchpath, staticdir)
-        self.cssout = renderpath + '/media/css'
         self.css_bundles = css_bundles
         self.js_bundles = js_bundles
-        self.jsout = renderpath + '/media/js'
         self.data = data
-        self._setup_env()
-        self._env.globals.update(settings=settings, **helper.contextfunctions)
+        self.trace = trace
+        self.tracer = tracing.Tracer(trace is not None)
+        with self.tracer.span('setup env', 'setup'):
+            self._setup_env()
+            self._env.globals.update(settings=settings, **helper.contextfunctions)
+        self.profile_helpers = profile_helpers
+        self.profiler = profiling.HelperProfiler()
+        if profile_helpers:
+            self.profiler.instrument(self._env, helper.contextfunctions)
+        self.templates = TemplateIndex(self._env)
         self.dev_mode = dev_mode
+        self.jobs = jobs
+        self.incremental = incremental
+        self.precompress = precompress
+        self.minify = minify
+        self._terser = None
+        self.hash_assets = hash_assets
+        self.link_media = link_media
+        self.split_bundles = split_bundles
+        self.prune_css = prune_css
+        self.critical_css = critical_css
+        self.optimize_svg = optimize_svg
+        self.svg_symbols = svg_symbols
+        svgstore.store.optimize = optimize_svg
+        svgstore.store.symbols = svg_symbols
+        svgstore.store.clear()
+        # Compiled css of the bundles by name. With `prune_css` they're only written once pruned at the end of the build.
+        self.css = {}
+        self.critical_cache = buildcache.FileCache(os.path.join(settings.BUILD_CACHE_PATH, 'critical'), '.css',
+                                                  settings.CRITICAL_CSS_CACHE_MAX_SIZE)
+        self.less_graph = assets.LessImportGraph(os.path.join(settings.BUILD_CACHE_PATH, 'less', 'graph.json'))
+        self.less_cache = buildcache.FileCache(os.path.join(settings.BUILD_CACHE_PATH, 'less'), '.css')
+        self.js_cache = buildcache.FileCache(os.path.join(settings.BUILD_CACHE_PATH, 'js'), '.json')
+        # Sizes in bytes of the pages minified in this build, before and after, by path relative to `renderpath`.
+        self.minified = {}
+        # Bytes of inline svg in the pages written in this build, by path relative to `renderpath`.
+        self.inlined_svg = {}
+        self.site_name = os.path.basename(os.path.normpath(renderpath))
+        self.manifest = buildcache.BuildManifest(os.path.join(settings.BUILD_CACHE_PATH, 'manifest', self.site_name + '.json'), renderpath)
+        self.redirect_map = redirectmap.RedirectMap(renderpath)
+        self._build_inputs = {}
+        self._media_inputs = {}
+        self._template_deps = {}
         if debug:
             logger.setLevel(logging.INFO)
 
+    @property
+    def cssout(self):
+        """Return path the css bundles are written to."""
+        return self.renderpath + '/media/css'
+
+    @property
+    def jsout(self):
+        """Return path the js bundles are written to."""
+        return self.renderpath + '/media/js'
+
     @property
     def outpath(self):
         """Return path for rendering that includes the current `lang`."""
@@ -170,43 +449,254 @@ class Site(object):
         self.context = {
             'LANG': self.lang,
             'DIR': self._text_dir(),
-            'NOW': datetime.datetime.now(datetime.UTC).replace(microsecond=0)
+            'NOW': buildcache.build_time()
         }
 
     def _setup_env(self):
         """Setup the Jinja2 environment, loader, extensions, and filters."""
         load = FileSystemLoader(self.searchpath)
-        self._env = Environment(loader=load, extensions=extensions)
+        self._env = Environment(loader=load, extensions=extensions, bytecode_cache=buildcache.bytecode_cache())
         self._env.filters["markdown"] = helper.safe_markdown
         self._env.filters["f"] = helper.f
         self._env.filters["l10n_format_date"] = helper.l10n_format_date
 
-    def _concat_js(self):
-        """Concatenate `js_bundles` and write to current `jsout`."""
+    def _begin_build(self):
+        """
+        Reset the per-build caches, hash the inputs that every output of this build depends on, and look for terser once
+        for all the js bundles.
+        """
+        self.manifest.begin()
+        self.redirect_map.pop()
+        self._media_inputs = {}
+        self._template_deps = {}
+
+        root = os.path.dirname(os.path.abspath(__file__))
+        inputs = {'code:' + name: self.manifest.file_hash(os.path.join(root, name)) for name in CODE_INPUTS}
+        # Only the Thunderbird files and languages.json are loaded by product_details.py.
+        product_files = sorted(f for f in os.listdir(settings.JSON_PATH) if f.startswith('thunderbird') or f == 'languages.json')
+        inputs['product-details'] = buildcache.fingerprint({f: self.manifest.file_hash(os.path.join(settings.JSON_PATH, f)) for f in product_files})
+        inputs['data'] = buildcache.fingerprint(self.data)
+        inputs['options'] = buildcache.fingerprint({'minify': self.minify, 'optimize_svg': self.optimize_svg,
+                                                    'svg_symbols': self.svg_symbols})
+        self._build_inputs = inputs
+        self._terser = assets.program_version(settings.TERSER_BIN) if self.minify and self.js_bundles else None
+        if self.minify and self.js_bundles and self._terser is None:
+            logger.warning("{0} isn't installed, the js bundles aren't minified.".format(settings.TERSER_BIN))
+        if self.hash_assets:
+            # Pages only built without assets refer to the hashed names of the last asset build.
+            self._set_asset_manifest(assets.load_manifest(os.path.join(self.renderpath, 'media')))
+
+    def _set_asset_manifest(self, manifest):
+        """Use the hashed asset names in `manifest` for static(), and render the pages again when they change."""
+        assets.manifest = manifest
+        self._build_inputs['assets'] = buildcache.fingerprint(manifest)
+
+    def _hash_media(self):
+        """
+        Give the media files content hashed names, recorded as outputs of the build, and write the manifest of them and
+        the .htaccess that marks them immutable to the media directory.
+        """
+        media = os.path.join(self.renderpath, 'media')
+        precompressed = [suffix for suffix, encoding, compress in PRECOMPRESSORS]
+        manifest = assets.hash_media(media, self.manifest, precompressed)
+        write_file(os.path.join(media, settings.ASSET_MANIFEST), json.dumps(manifest, indent=2, sort_keys=True), self.manifest)
+        write_htaccess_custom(media, assets.immutable_htaccess_rules(), self.manifest)
+        self._set_asset_manifest(manifest)
+
+    def _media_input(self, key):
+        """Return the hash of a media build input, either the contents of the svg files or the list of all media files."""
+        if key not in self._media_inputs:
+            media = settings.MEDIA_URL.strip('/')
+            files = sorted(assets.media.files)
+            if key == 'media:svg':
+                value = {f: self.manifest.file_hash(os.path.join(media, f)) for f in files if f.startswith('svg' + os.sep)}
+            else:
+                value = files
+            self._media_inputs[key] = buildcache.fingerprint(value)
+        return self._media_inputs[key]
+
+    def _template_closure(self, name):
+        """
+        Return a (templates, names) tuple for the template `name`: the set of templates it extends, includes or imports,
+        recursively and including itself, and the set of variable names they use, which tells us the helpers it calls.
+        A dynamic include that can't be resolved is added as None to `templates`.
+        """
+        if name in self._template_deps:
+            return self._template_deps[name]
+        templates, names = {name}, set()
+        self._template_deps[name] = (templates, names)
+        source = self._env.loader.get_source(self._env, name)[0]
+        ast = self._env.parse(source, name)
+        names.update(node.name for node in ast.find_all(jinja2.nodes.Name))
+        for ref in jinja2.meta.find_referenced_templates(ast):
+            if ref is None:
+                templates.add(None)
+                continue
+            ref_templates, ref_names = self._template_closure(ref)
+            templates.update(ref_templates)
+            names.update(ref_names)
+        return templates, names
+
+    def _page_templates(self, template):
+        """
+        Return the (templates, names) closure of the page `template`, including the download button if it renders one.
+        If it has a dynamic include we can't tell what that loads, so every template is included.
+        """
+        templates, names = self._template_closure(template)
+        if 'download_thunderbird' in names:
+            button_templates, button_names = self._template_closure(DOWNLOAD_BUTTON_TEMPLATE)
+            templates = templates | button_templates
+            names = names | button_names
+        if None in templates:
+            templates = set(self._env.list_templates(filter_func=lambda t: t.endswith('.html')))
+        return templates, names
+
+    def _page_inputs(self, template):
+        """Return the inputs, mapped to their hashes, that rendering `template` in the current `lang` depends on."""
+        templates, names = self._page_templates(template)
+        inputs = dict(self._build_inputs)
+        for name in templates:
+            inputs['template:' + name] = self.manifest.file_hash(os.path.join(self.searchpath, name))
+        catalog = translate.catalog_path(self.lang)
+        inputs['catalog'] = self.manifest.file_hash(catalog) if catalog else None
+        for name in names.intersection(MEDIA_HELPERS):
+            inputs[MEDIA_HELPERS[name]] = self._media_input(MEDIA_HELPERS[name])
+        return inputs
+
+    def _is_critical_page(self, template):
+        """Return whether the page `template` gets its critical css inlined, see _inline_critical_css."""
+        patterns = settings.CRITICAL_CSS_PAGES.get(os.path.basename(os.path.normpath(self.searchpath)), ())
+        return self.critical_css and any(fnmatch.fnmatch(template, pattern) for pattern in patterns)
+
+    def _inline_critical_css(self, template, html):
+        """
+        Return the rendered page `html` with the rules of its css bundles that can match what's above the fold inlined,
+        and the bundles loaded without blocking rendering. The critical css is cached by template, text direction and the
+        class names and ids above the fold, so it's normally extracted once per template and direction, not per locale.
+        """
+        links = stylesheets.stylesheet_links(html, self.css)
+        if not links:
+            return html
+        above = stylesheets.above_the_fold(html, settings.CRITICAL_CSS_FOLD)
+        key = buildcache.fingerprint({
+            'template': template,
+            'dir': self._text_dir(),
+            'names': sorted(stylesheets.used_names(above)),
+            'css': [(url, buildcache.hash_bytes(self.css[name])) for tag, url, name in links],
+        })
+        critical = self.critical_cache.get(key)
+        if critical is None:
+            critical = '\n'.join(
+                stylesheets.rebase_urls(stylesheets.critical_css(self.css[name], html, settings.CRITICAL_CSS_FOLD), url)
+                for tag, url, name in links)
+            self.critical_cache.set(key, critical)
+        return stylesheets.inline_critical_css(html, links, critical)
+
+    def _is_fresh(self, filepath, inputs):
+        """Return whether `filepath` can be skipped, which is only the case for incremental builds if its inputs are unchanged."""
+        return self.incremental and self.manifest.is_fresh(filepath, inputs)
+
+    def _page_usage(self, template):
+        """
+        Return what the page `template` uses: the css bundles its templates refer to, and the files of each js bundle it
+        needs. A file in `settings.JS_MODULE_USAGE` is only needed if one of its markers is the name of a helper or
+        variable the templates use, or appears in their source.
+        """
+        templates, names = self._page_templates(template)
+        source = '\n'.join(self._env.loader.get_source(self._env, name)[0] for name in sorted(templates))
+        js = {}
+        for bundle_name, files in self.js_bundles.items():
+            js[bundle_name] = [file for file in files if file not in settings.JS_MODULE_USAGE
+                               or any(marker in names or marker in source for marker in settings.JS_MODULE_USAGE[file])]
+        return {'css': sorted(name for name in self.css_bundles if 'css/{0}.css'.format(name) in source), 'js': js}
+
+    def _write_js_bundle(self, bundle_name, files):
+        """
+        Bundle `files` into `bundle_name`.js in the current `jsout`. With `minify` (and terser installed) the bundle is
+        minified, and gets a source map written next to it.
+        """
+        bundle_path = self.jsout + '/' + bundle_name + '.js'
+
+        js_string, source_map = assets.build_js_bundle(files, self.js_cache, self._terser)
+        if source_map is not None:
+            source_map['file'] = bundle_name + '.js'
+            write_file(bundle_path + '.map', json.dumps(source_map), self.manifest)
+            js_string += '\n//# sourceMappingURL={0}.js.map\n'.format(bundle_name)
+        write_file(bundle_path, js_string, self.manifest)
+
+    def _build_js(self):
+        """Bundle `js_bundles` and write to current `jsout`, split for every page with `split_bundles`."""
         for bundle_name, files in self.js_bundles.items():
-            bundle_path = self.jsout + '/' + bundle_name + '.js'
+            with self.tracer.span(bundle_name, 'js'):
+                self._write_js_bundle(bundle_name, files)
+        if self.split_bundles:
+            self._split_js()
 
-            js_string = '\n'.join(read_file(settings.ASSETS + '/' + file) for file in files)
-            with open(bundle_path, 'w') as f:
-                f.write(js_string)
+    def _split_js(self):
+        """
+        Write js bundles of only the files each page needs, and the manifest of the bundles every page uses.
+        Pages that need the same files share a bundle, named after the full bundle and a hash of its files, e.g.
+        common-bundle-0123abcd.js. Pages that need every file of a bundle keep using the full one.
+        """
+        pages = list(self.templates.pages)
+        pages.extend(template for template, path in NOTE_PAGES if os.path.exists(os.path.join(self.searchpath, template)))
+        usage = {}
+        split = {}
+        page_bundles = {}
+        for template in pages:
+            page = self._page_usage(template)
+            names = {}
+            for bundle_name, files in page['js'].items():
+                if files != self.js_bundles[bundle_name]:
+                    names[bundle_name] = '{0}-{1}'.format(bundle_name, buildcache.fingerprint(files)[:8])
+                    split[names[bundle_name]] = files
+            page_bundles[template] = names
+            usage[template] = {'css': page['css'], 'js': sorted(names.get(name, name) for name in page['js'])}
+
+        for bundle_name, files in sorted(split.items()):
+            with self.tracer.span(bundle_name, 'js'):
+                self._write_js_bundle(bundle_name, files)
+        manifest = {'bundles': dict(self.js_bundles, **split), 'pages': usage}
+        write_file(os.path.join(self.renderpath, 'media', settings.BUNDLE_MANIFEST),
+                   json.dumps(manifest, indent=2, sort_keys=True), self.manifest)
+        assets.bundles = page_bundles
+        self._build_inputs['bundles'] = buildcache.fingerprint(page_bundles)
 
     def _switch_lang(self, lang):
         """Switch current `lang` for build and update gettext translations accordingly."""
-        self.lang = lang
-        self._set_context()
-        self._env.globals.update(self.context)
-        translator = translate.gettext_object(lang)
-        self._env.install_gettext_translations(translator)
-        self._env.globals.update(translations=translator.get_translations(), l10n_css=translator.l10n_css)
+        with self.tracer.span('switch lang', 'setup', lang=lang):
+            self.lang = lang
+            self._set_context()
+            self._env.globals.update(self.context)
+            translator = translate.gettext_object(lang)
+            self._env.install_gettext_translations(translator)
+            self._env.globals.update(translations=translator.get_translations(), l10n_css=translator.l10n_css)
+
+    def _root_rules(self):
+        """Return the .htaccess rules for the whole site: the favicon, and serving precompressed files if we write them."""
+        rules = 'RewriteEngine On\nRewriteRule ^favicon.ico$ {path}\n'.format(path=settings.FAVICON_PATH)
+        if self.precompress:
+            rules += precompress_htaccess_rules()
+        return rules
+
+    def _write_root_htaccess(self):
+        """
+        Write the .htaccess in `self.renderpath`, with the 404 page for root accesses outside lang dirs.
+        It includes the rules for the whole site up front, so _write_favicon_htaccess doesn't have to change the file afterwards.
+        """
+        with self.tracer.span('root htaccess', 'htaccess'):
+            write_404_htaccess(self.renderpath, 'en-US', self.manifest, self._root_rules(), self.redirect_map)
 
     def _write_favicon_htaccess(self):
-        """Write an .htaccess to `self.renderpath` that points to the favicon."""
+        """Write an .htaccess to `self.renderpath` that points to the favicon (and other rules for the whole site), unless it already does."""
         htpath = os.path.join(self.renderpath, '.htaccess')
-        mode = 'w'
+        rules = ''
         if os.path.isfile(htpath):
-            mode = 'a'
-        with open(htpath, mode) as f:
-            f.write('RewriteEngine On\nRewriteRule ^favicon.ico$ {path}\n'.format(path=settings.FAVICON_PATH))
+            rules = read_file(htpath)
+        if not rules.endswith(self._root_rules()):
+            rules += self._root_rules()
+        write_file(htpath, rules, self.manifest)
+        self.redirect_map.redirect(os.path.join(self.renderpath, 'favicon.ico'), settings.FAVICON_PATH)
 
     def _copy_apple_pay_domain_verification(self):
         """Copies over FRU's merchantid to `self.renderpath/.well-known` for Apple Pay domain verification purposes"""
@@ -216,37 +706,23 @@ class Site(object):
         folder_path = "{0}/.well-known".format(self.renderpath)
         file_name = "apple-developer-merchantid-domain-association"
 
-        mkdir(folder_path)
-        shutil.copy("{0}/misc/{1}".format(settings.ASSETS, file_name), "{0}/{1}".format(folder_path, file_name))
-
-    def is_css_bundle(self, path):
-        """Check if a path refers to a css file that is in the current `css_bundles` or not."""
-        changed_file = ntpath.basename(path).split('.')[0]
-        bundle = ''
-        for bundle_name, files in self.css_bundles.items():
-            for file in files:
-                if changed_file in file:
-                    bundle = bundle_name
-        return bundle
+        with open("{0}/misc/{1}".format(settings.ASSETS, file_name), 'rb') as f:
+            write_file("{0}/{1}".format(folder_path, file_name), f.read(), self.manifest)
 
     def partial_asset_build(self, path, timemsg=''):
         """Check if `path` refers to a changed css or js and only build that asset if possible, for improved performance."""
         if 'less' in path:
-            bundle = self.is_css_bundle(path)
-            if bundle:
-                env = webassets.Environment(load_path=[settings.ASSETS],
-                    directory=self.cssout, url=settings.MEDIA_URL, cache=False, manifest=False)
-                css_files = self.css_bundles[bundle]
-                reg = webassets.Bundle(*css_files, filters='less', output=bundle + '.css')
-                env.register(bundle, reg)
-                env[bundle].urls()
-                print("{0}: CSS bundle rebuilt: {1}.".format(timemsg, bundle))
-            else:
-                print("{0}: All Assets rebuilt.".format(timemsg))
-                self.build_assets()
+            # Only the bundles that import the changed file are compiled again.
+            compiled = self._build_css()
+            if self.prune_css:
+                self._prune_css()
+            print("{0}: CSS bundles rebuilt: {1}.".format(timemsg, ', '.join(compiled) or 'none'))
         elif 'js' in path:
             if self.js_bundles:
-                self._concat_js()
+                self._build_js()
+                if self.prune_css:
+                    # The scripts may add other classes.
+                    self._prune_css()
                 print("{0}: JS bundles rebuilt.".format(timemsg))
             else:
                 print("{0}: All Assets rebuilt.".format(timemsg))
@@ -256,61 +732,140 @@ class Site(object):
             print("{0}: All Assets rebuilt.".format(timemsg))
             self.build_assets()
 
-    def build_notes(self):
-        """Build the release notes and system requirements portions of the site in en-US only."""
+    def _write_page(self, filepath, html, inputs):
+        """Write the rendered page `html` to `filepath`, minified if enabled, and record it was built from `inputs`."""
+        if self.minify and filepath.endswith('.html'):
+            size = len(html.encode('utf-8'))
+            html = minify.minify_html(html)
+            minified_size = len(html.encode('utf-8'))
+            key = os.path.relpath(filepath, self.renderpath)
+            self.minified[key] = (size, minified_size)
+            logger.info("Minified {0}: saved {1} bytes.".format(key, size - minified_size))
+        if filepath.endswith('.html'):
+            key = os.path.relpath(filepath, self.renderpath)
+            self.inlined_svg[key] = svgstore.inlined_bytes(html)
+            logger.info("Inlined {0} bytes of svg in {1}.".format(self.inlined_svg[key], key))
+        write_file(filepath, html, self.manifest)
+        self.manifest.record(filepath, inputs)
+
+    def _pop_results(self):
+        """
+        Return and clear what this build collected: manifest records, minified sizes, inline svg sizes, redirects, trace
+        events and helper calls. Used to collect them from workers.
+        """
+        minified, self.minified = self.minified, {}
+        inlined_svg, self.inlined_svg = self.inlined_svg, {}
+        return {'records': self.manifest.pop_records(), 'minified': minified, 'inlined_svg': inlined_svg,
+                'redirects': self.redirect_map.pop(), 'trace': self.tracer.pop(), 'helpers': self.profiler.pop()}
+
+    def _merge_results(self, results):
+        """Merge the `results` of _pop_results collected elsewhere (e.g. a worker process) into this build."""
+        self.manifest.update(*results['records'])
+        self.minified.update(results['minified'])
+        self.inlined_svg.update(results['inlined_svg'])
+        self.redirect_map.update(*results['redirects'])
+        self.tracer.extend(results['trace'])
+        self.profiler.update(results['helpers'])
+
+    def _render_note(self, context, outputs):
+        """
+        Render one release note with its own `context`, instead of mixing the note into the environment's globals.
+        `outputs` is a list of (template, filepath, inputs) tuples for the note pages that need to be rendered.
+        """
+        if self.lang != 'en-US':
+            self._switch_lang('en-US')
+        for template, filepath, inputs in outputs:
+            logger.info("Rendering {0}...".format(filepath))
+            self.profiler.page = (template, self.lang)
+            with self.tracer.span(template, 'render', lang=self.lang, path=os.path.relpath(filepath, self.renderpath)):
+                svgstore.store.begin_page()
+                html = svgstore.store.end_page(self._env.get_template(template).render(context))
+                self._write_page(filepath, html, inputs)
+
+    def _render_notes(self, tasks, pool=None):
+        """
+        Render the release note `tasks`, a list of (context, outputs) arguments for _render_note.
+        They're handed to `pool`, or a new pool of `jobs` workers if there is no pool and we have more than one job.
+        """
+        if pool is None and self.jobs > 1 and len(tasks) > 1:
+            ctx = multiprocessing.get_context('fork')
+            with ctx.Pool(self.jobs, initializer=_init_worker, initargs=(self,)) as pool:
+                return self._render_notes(tasks, pool)
+
+        if pool is None:
+            for context, outputs in tasks:
+                self._render_note(context, outputs)
+            return
+
+        chunksize = max(1, len(tasks) // (self.jobs * 4))
+        for results in pool.starmap(_render_note_worker, tasks, chunksize):
+            self._merge_results(results)
+
+    def build_notes(self, pool=None):
+        """
+        Build the release notes and system requirements portions of the site in en-US only.
+        With incremental builds only new or changed notes are rendered, and with more than one job they're rendered in
+        parallel, using `pool` if we were given one.
+        """
         if self.lang != 'en-US':
             self._switch_lang('en-US')
 
         notelist = releasenotes.notes
-        note_template = self._env.get_template('includes/_enonly/release-notes.html')
-        self._env.globals.update(feedback=releasenotes.settings["feedback"], bugzilla=releasenotes.settings["bugzilla"])
+        note_settings = {'feedback': releasenotes.settings["feedback"], 'bugzilla': releasenotes.settings["bugzilla"]}
         feed_items = []
+        tasks = []
         for k, n in notelist.items():
             is_beta = 'beta' in k
             is_115_esr = k.startswith('115.') and k.endswith('esr')
 
             if is_beta:
-                self._env.globals.update(channel='Beta', channel_name='Beta')
+                context = dict(note_settings, channel='Beta', channel_name='Beta')
             else:
-                self._env.globals.update(channel='Release', channel_name='Release')
+                context = dict(note_settings, channel='Release', channel_name='Release')
             n["release"]["release_date"] = n["release"].get("release_date", helper.thunderbird_desktop.get_release_date(k))
 
             # If there's no data at all, we can't parse an empty string for a date.
             if n["release"]["release_date"]:
                 n["release"]["release_date"] = parse(str(n["release"]["release_date"]))
-            self._env.globals.update(**n)
-            target = os.path.join(self.outpath, 'thunderbird', str(k), 'releasenotes')
-            mkdir(target)
-            logger.info("Rendering {0}/index.html...".format(target))
-            note_template.stream().dump(os.path.join(target, 'index.html'))
-
-            target = os.path.join(self.outpath, 'thunderbird', str(k), 'system-requirements')
-            mkdir(target)
-            sysreq_template = self._env.get_template('includes/_enonly/system_requirements.html')
-            logger.info("Rendering {0}/index.html...".format(target))
-            sysreq_template.stream().dump(os.path.join(target, 'index.html'))
+            context.update(**n)
+
+            note_hash = buildcache.fingerprint([k, n])
+            outputs = []
+            for template, path in NOTE_PAGES:
+                filepath = os.path.join(self.outpath, 'thunderbird', str(k), path, 'index.html')
+                inputs = dict(self._page_inputs(template), note=note_hash)
+                if not self._is_fresh(filepath, inputs):
+                    outputs.append((template, filepath, inputs))
+            if outputs:
+                tasks.append((context, outputs))
 
             # 115 swapped to esr midway through. So add an 115 alias for 115esr builds
             if is_115_esr:
                 for path in ['releasenotes', 'system-requirements']:
                     k_noesr = k.replace('esr', '')
                     source = os.path.join(self.outpath, 'thunderbird', str(k_noesr), path)
-                    mkdir(source)
-                    write_htaccess(source, urllib.parse.urljoin(settings.CANONICAL_URL, f'thunderbird/{str(k)}/{path}'))
+                    with self.tracer.span('notes htaccess', 'htaccess'):
+                        write_htaccess(source, urllib.parse.urljoin(settings.CANONICAL_URL, f'thunderbird/{str(k)}/{path}'), self.manifest,
+                                       self.redirect_map)
 
             # Add entry to our feed items, optionally filter out beta notes
             if not is_beta or (is_beta and settings.SHOW_BETA_NOTES_IN_RSS_FEED):
                 feed_items.append((k, n))
 
+        self._render_notes(tasks, pool)
+
         # Build htaccess files for sysreq and release notes redirects.
         sysreq_path = os.path.join(self.renderpath, 'system-requirements')
         notes_path = os.path.join(self.renderpath, 'notes')
         beta_notes_path = os.path.join(self.renderpath, 'notes', 'beta')
-        write_htaccess(sysreq_path, settings.CANONICAL_URL + helper.thunderbird_url('system-requirements'))
-        write_htaccess(notes_path, settings.CANONICAL_URL + helper.thunderbird_url('releasenotes'))
-        write_htaccess(beta_notes_path, settings.CANONICAL_URL + helper.thunderbird_url('releasenotes', channel="beta"))
+        with self.tracer.span('notes htaccess', 'htaccess'):
+            write_htaccess(sysreq_path, settings.CANONICAL_URL + helper.thunderbird_url('system-requirements'), self.manifest, self.redirect_map)
+            write_htaccess(notes_path, settings.CANONICAL_URL + helper.thunderbird_url('releasenotes'), self.manifest, self.redirect_map)
+            write_htaccess(beta_notes_path, settings.CANONICAL_URL + helper.thunderbird_url('releasenotes', channel="beta"), self.manifest,
+                           self.redirect_map)
 
-        self.build_notes_feed(feed_items)
+        with self.tracer.span('feed', 'notes'):
+            self.build_notes_feed(feed_items)
 
     def build_notes_feed(self, feed_items):
         """ Builds the release notes atom.xml file. Like build_notes, this is en-US only. """
@@ -339,7 +894,7 @@ class Site(object):
         feed_template = self._env.get_template('includes/atom-feed.html')
         content_template = self._env.get_template('includes/release-notes-feed.html')
 
-        self._env.globals.update(feedback=releasenotes.settings["feedback"], bugzilla=releasenotes.settings["bugzilla"])
+        note_settings = {'feedback': releasenotes.settings["feedback"], 'bugzilla': releasenotes.settings["bugzilla"]}
 
         fake_context = {'LANG': 'en-US'}
         feed_context = {
@@ -362,20 +917,20 @@ class Site(object):
 
             title = "Thunderbird {}".format(version)
 
-            self._env.globals.update(channel='Release', channel_name='Release')
+            context = dict(note_settings, channel='Release', channel_name='Release')
 
             if settings.SHOW_BETA_NOTES_IN_RSS_FEED and 'beta' in version:
                 # Remove redundant beta from title
                 title = "Thunderbird Beta {}".format(version.replace('beta', ''))
-                self._env.globals.update(channel='Beta', channel_name='Beta')
+                context.update(channel='Beta', channel_name='Beta')
 
             link = "{}/{}/thunderbird/{}/releasenotes/".format(settings.CANONICAL_URL, self.lang, version)
 
             # Mix in our notes for the template
-            self._env.globals.update(**note)
+            context.update(**note)
 
             # Pull in and minify our template
-            content = content_template.render({'version_number': version, 'link': link})
+            content = content_template.render({'version_number': version, 'link': link, **context})
 
             # Note: Published Date is DateTime, but Updated Date is a string!
             published_date = release_notes.get('release_date')
@@ -404,44 +959,100 @@ class Site(object):
 
         # Render our atom template and write it to atom.xml
         feed_xml = feed_template.render({'entries': entries, **feed_context})
-        with open(os.path.join(self.outpath, 'thunderbird', 'releases', 'atom.xml'), "w") as fh:
-            fh.write(feed_xml)
+        feed_path = os.path.join(self.outpath, 'thunderbird', 'releases', 'atom.xml')
+        write_file(feed_path, feed_xml, self.manifest)
+
+    def _sync_media(self):
+        """
+        Sync `staticpath` to the media directory of `renderpath`. Only the files that are new or changed (by size and
+        mtime) since they were last synced are copied, or hardlinked with `link_media`, and deleted files are removed.
+        """
+        media = os.path.join(self.renderpath, 'media')
+        synced = set()
+        for dirpath, dirnames, filenames in os.walk(self.staticpath, followlinks=True):
+            for filename in filenames:
+                source = os.path.join(dirpath, filename)
+                dest = os.path.join(media, os.path.relpath(source, self.staticpath))
+                stat = os.stat(source)
+                inputs = {'media:file': '{0}:{1}'.format(stat.st_size, stat.st_mtime_ns)}
+                synced.add(os.path.relpath(dest, self.renderpath))
+                if self.manifest.is_fresh(dest, inputs):
+                    continue
+                copy_file(source, dest, self.link_media)
+                self.manifest.produce(dest)
+                self.manifest.record(dest, inputs)
+
+        for key, inputs in list(self.manifest.outputs.items()):
+            if inputs and 'media:file' in inputs and key not in synced:
+                logger.info("Removing {0}...".format(key))
+                remove_output(os.path.join(self.renderpath, key), self.renderpath)
+                self.manifest.remove(os.path.join(self.renderpath, key))
+
+    def _build_css(self):
+        """
+        Compile the `css_bundles` in parallel and write them to `cssout`. Returns the names of the bundles that had to be
+        compiled, the others are taken from the cache because nothing in their import graph changed.
+        With `prune_css` the bundles are only written once the pages are rendered, by _prune_css.
+        """
+        def build(name):
+            with self.tracer.span(name, 'less'):
+                return assets.build_less_bundle(self.css_bundles[name], self.less_graph, self.less_cache)
+
+        names = list(self.css_bundles)
+        compiled = []
+        if not names:
+            return compiled
+        with multiprocessing.pool.ThreadPool(min(len(names), os.cpu_count()) or 1) as pool:
+            for name, (css, was_compiled) in zip(names, pool.map(build, names)):
+                self.css[name] = css
+                if not self.prune_css:
+                    write_file(os.path.join(self.cssout, name + '.css'), css, self.manifest)
+                if was_compiled:
+                    logger.info("Compiled {0}.css".format(name))
+                    compiled.append(name)
+        self.less_graph.save()
+        return compiled
 
     def build_assets(self):
-        """Build assets, that is, bundle and compile the LESS and JS files in `settings.ASSETS`."""
-        shutil.rmtree(self.renderpath + '/media', ignore_errors=True)
-        shutil.copytree(self.staticpath, self.renderpath + '/media')
-        env = webassets.Environment(load_path=[settings.ASSETS], directory=self.cssout, url=settings.MEDIA_URL, cache=False, manifest=False)
-        for k, v in self.css_bundles.items():
-            reg = webassets.Bundle(*v, filters='less', output=k + '.css')
-            env.register(k, reg)
-            env[k].urls()
+        """Build assets, that is, sync the media files and bundle and compile the LESS and JS files in `settings.ASSETS`."""
+        with self.tracer.span('media sync', 'assets'):
+            self._sync_media()
+        with self.tracer.span('less', 'assets'):
+            self._build_css()
         if self.js_bundles:
-            self._concat_js()
-        self._write_favicon_htaccess()
+            with self.tracer.span('js', 'assets'):
+                self._build_js()
+        if self.hash_assets:
+            with self.tracer.span('hash media', 'assets'):
+                self._hash_media()
+        with self.tracer.span('favicon htaccess', 'htaccess'):
+            self._write_favicon_htaccess()
         self._copy_apple_pay_domain_verification()
 
     def render(self):
         """
-        Iterate through the templates loaded into Jinja2 and build them, including any needed directories.
+        Iterate through the pages in the template index and build them, including any needed directories.
         If '_' or 'includes' are in front of a template or folder they will be skipped by this method.
         Non-html files will also be skipped.
         """
-        for template in self._env.list_templates():
-            filename = os.path.basename(template)
-            # Ignore non-html files, or any path that starts with `_` or `includes`.
-            if not filename.endswith('.html') or template.startswith("_") or template.startswith("includes"):
-                continue
-
+        for template in self.templates.pages:
             filepath = os.path.join(self.outpath, template)
-            # Make sure the output directory exists.
-            filedir = os.path.dirname(filepath)
-            if not os.path.exists(filedir):
-                os.makedirs(filedir)
+            inputs = self._page_inputs(template)
+            critical = self._is_critical_page(template)
+            if critical:
+                inputs['css'] = buildcache.fingerprint({name: buildcache.hash_bytes(css) for name, css in self.css.items()})
+            if self._is_fresh(filepath, inputs):
+                continue
 
+            self.profiler.page = (template, self.lang)
             try:
-                t = self._env.get_template(template)
-                t.stream().dump(filepath)
+                with self.tracer.span(template, 'render', lang=self.lang):
+                    svgstore.store.begin_page()
+                    t = self._env.get_template(template)
+                    html = svgstore.store.end_page(t.render())
+                    if critical:
+                        html = self._inline_critical_css(template, html)
+                    self._write_page(filepath, html, inputs)
             except jinja2.exceptions.TemplateSyntaxError as ex:
                 logger.error(f">> Jinja Syntax Error: \"{ex.message}\"\n>> In file \"{ex.filename}\" on line {ex.lineno}.")
 
@@ -458,39 +1069,304 @@ class Site(object):
 
                 raise ex
 
-    def build_startpage(self):
-        """Build the start page for all `languages`."""
-        delete_contents(self.renderpath)
-        for lang in self.languages:
-            logger.info("Building pages for {lang}...".format(lang=lang))
-            self._switch_lang(lang)
-            self.render()
-        self.build_assets()
+    def _begin_staging(self):
+        """
+        Point `renderpath` at a new versioned directory next to it, so the served directory stays complete while we build.
+        The outputs of the previous build are hardlinked into it, so unchanged files are reused as they are. That's only
+        safe because outputs are always replaced by write_file, never rewritten in place.
+        Versioned directories left over from builds that didn't finish are removed.
+        """
+        live = os.path.normpath(self.renderpath)
+        current = os.path.realpath(live)
+        for leftover in glob.glob(glob.escape(live) + '.build-*') + [live + '.staging', live + '.old']:
+            if os.path.realpath(leftover) != current:
+                shutil.rmtree(leftover, ignore_errors=True)
+        staging = '{0}.build-{1}'.format(live, time.time_ns())
+        os.makedirs(staging)
+        for output in self.manifest.outputs:
+            target = os.path.join(staging, output)
+            try:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.link(os.path.join(live, output), target)
+            except FileNotFoundError:
+                pass
+        self._live_renderpath = self.renderpath
+        self.renderpath = self.manifest.root = self.redirect_map.root = staging
+
+    def _finish_staging(self):
+        """
+        Prune the outputs of the previous build that weren't produced by this one, and publish the versioned directory:
+        `renderpath` becomes a symlink to it in one step (see buildcache.publish), then the previous build is removed.
+        """
+        staging = self.renderpath
+        for output in self.manifest.stale():
+            logger.info("Removing {0}...".format(output))
+            remove_output(os.path.join(staging, output), staging)
 
-    def build_website(self, assets=True, notes=True):
+        previous = buildcache.publish(staging, self._live_renderpath)
+        if previous is not None and os.path.realpath(previous) != os.path.realpath(staging):
+            shutil.rmtree(previous, ignore_errors=True)
+        self.renderpath = self.manifest.root = self.redirect_map.root = self._live_renderpath
+
+    def precompress_outputs(self):
         """
-        Build the website for all `languages.`
-        `assets` and `notes` set False allow skipping of build_assets() and build_notes()
+        Write gzip (and brotli) compressed siblings of every text output in `renderpath`, using all cores.
+        Siblings that are newer than their file are left alone, so only new and changed files are compressed.
         """
-        if assets and notes:
-            delete_contents(self.renderpath)
-        self._env.globals.update(self.data)
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(self.renderpath):
+            paths.extend(os.path.join(dirpath, filename) for filename in filenames)
+        paths = [path for path in paths if is_precompressible(path)]
+
+        logger.info("Precompressing {0} files...".format(len(paths)))
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool() as pool:
+            for siblings in pool.imap_unordered(precompress_file, paths, chunksize=16):
+                for sibling, changed in siblings:
+                    self.manifest.produce(sibling, changed)
+
+    def _prune_css(self, full=False):
+        """
+        Write the compiled css bundles without the rules that can't match anything in the rendered pages, and print how
+        many bytes that removed from each bundle. The class names and ids the pages use are collected from every html
+        and js output, using all cores. Only a `full` build knows all of its outputs, other builds also look at the
+        outputs of the previous builds.
+        """
+        outputs = set(self.manifest.records)
+        if not full:
+            outputs.update(self.manifest.outputs)
+        paths = [os.path.join(self.renderpath, output) for output in sorted(outputs) if output.endswith(('.html', '.js'))]
+        paths = [path for path in paths if os.path.exists(path)]
+
+        logger.info("Collecting the classes and ids used by {0} files...".format(len(paths)))
+        used = set()
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool() as pool:
+            for names in pool.imap_unordered(stylesheets.file_names, paths, chunksize=16):
+                used.update(names)
+
+        pruned = {}
+        for name, css in sorted(self.css.items()):
+            pruned_css = stylesheets.prune_css(css, used)
+            write_file(os.path.join(self.cssout, name + '.css'), pruned_css, self.manifest)
+            pruned[name] = (len(css.encode('utf-8')), len(pruned_css.encode('utf-8')))
+        print_prune_report(pruned)
+
+    def _finish_build(self, full):
+        """
+        Prune and write the css bundles, precompress the outputs, publish the versioned directory of a `full` build,
+        write the redirect map and the report of changed files, and save the build manifest.
+        The report is a json file in `renderpath` listing the added, changed and removed outputs, so deploys can push
+        (and purge from the CDN) only what actually changed.
+        """
+        if self.minified:
+            print_minify_report(self.minified)
+            self.minified = {}
+        if self.inlined_svg:
+            if self.optimize_svg:
+                print_svg_report(self.inlined_svg)
+            self.inlined_svg = {}
+        if self.prune_css and self.css:
+            with self.tracer.span('prune css', 'finish'):
+                self._prune_css(full)
+        if self.precompress:
+            with self.tracer.span('precompress', 'finish'):
+                self.precompress_outputs()
+        if full:
+            with self.tracer.span('finish staging', 'finish'):
+                self._finish_staging()
+        if full and (self.redirect_map.redirects or self.redirect_map.not_found):
+            # Only a full build has seen every redirect.
+            self.redirect_map.write(settings.REDIRECT_MAP_PATH, self.site_name, write_file)
+        self.redirect_map.pop()
+        changes = self.manifest.changes(full)
+        write_file(os.path.join(self.renderpath, settings.BUILD_CHANGES_FILE), json.dumps(changes, indent=2))
+        logger.info("{0} added, {1} changed, {2} removed.".format(*map(len, changes.values())))
+        self.manifest.save(full)
+        if self.trace:
+            self.tracer.write(self.trace)
+            print_trace_summary(self.tracer.pop())
+            print("Wrote the build trace to {0}.".format(self.trace))
+        if self.profile_helpers:
+            print_helper_report(self.profiler.stats)
+            if isinstance(self.profile_helpers, str):
+                self.profiler.write(self.profile_helpers)
+                print("Wrote the helper calls to {0}.".format(self.profile_helpers))
+            self.profiler.pop()
+
+    def build_startpage(self, stage=True):
+        """
+        Build the start page for all `languages`.
+        With `stage` the build is written to a staging directory that replaces `renderpath` once it's complete.
+        """
+        if stage:
+            self._begin_staging()
+        with self.tracer.span('begin build', 'setup'):
+            self._begin_build()
+        # Assets go first, the pages refer to their hashed names.
+        self.build_assets()
         for lang in self.languages:
             logger.info("Building pages for {lang}...".format(lang=lang))
+            with self.tracer.span(lang, 'locale'):
+                self._switch_lang(lang)
+                self.render()
+        self._finish_build(stage)
+
+    def _build_locale(self, lang):
+        """Render the pages and per-locale .htaccess files for `lang`. Returns a (lang, seconds) timing tuple."""
+        start = time.perf_counter()
+        logger.info("Building pages for {lang}...".format(lang=lang))
+        with self.tracer.span(lang, 'locale'):
             self._switch_lang(lang)
             self.render()
-            write_404_htaccess(self.outpath, self.lang)
+            with self.tracer.span('locale htaccess', 'htaccess', lang=lang):
+                write_404_htaccess(self.outpath, self.lang, self.manifest, redirect_map=self.redirect_map)
 
-            write_site_htaccess(self.renderpath, self.lang, settings.WEBSITE_REDIRECTS)
+                write_site_htaccess(self.renderpath, self.lang, settings.WEBSITE_REDIRECTS, self.manifest, self.redirect_map)
+        return lang, time.perf_counter() - start
 
-            if lang == 'en-US':
+    def _build_locales_parallel(self, notes):
+        """
+        Render all `languages` in a pool of `jobs` forked worker processes.
+        Each worker keeps its own copy of this site, so the Jinja2 environment stays warm between the locales it renders.
+        The en-US-only outputs (root 404 and release notes) are prepared by this process while the workers render.
+        """
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(self.jobs, initializer=_init_worker, initargs=(self,)) as pool:
+            result = pool.map_async(_build_locale_worker, self.languages, chunksize=1)
+            if 'en-US' in self.languages:
+                self._switch_lang('en-US')
                 # 404 page for root accesses outside lang dirs.
-                write_404_htaccess(self.renderpath, self.lang)
+                self._write_root_htaccess()
                 if notes:
-                    self.build_notes()
+                    # The note renders are queued behind the locales, in the same pool.
+                    with self.tracer.span('notes', 'notes'):
+                        self.build_notes(pool)
+            results = result.get()
+
+        timings = []
+        for timing, worker_results in results:
+            timings.append(timing)
+            self._merge_results(worker_results)
+        return timings
+
+    def build_website(self, assets=True, notes=True):
+        """
+        Build the website for all `languages.`
+        `assets` and `notes` set False allow skipping of build_assets() and build_notes()
+        A full build is written to a staging directory that replaces `renderpath` once it's complete, partial builds are
+        written in place.
+        """
+        stage = assets and notes
+        if stage:
+            self._begin_staging()
+        self._env.globals.update(self.data)
+        with self.tracer.span('begin build', 'setup'):
+            self._begin_build()
         if assets:
+            # Assets go first, the pages refer to their hashed names.
             logger.info("Building assets...")
             self.build_assets()
+        elif self.split_bundles and self.js_bundles:
+            # The templates may have changed what the pages need.
+            self._split_js()
+        start = time.perf_counter()
+        if self.jobs > 1 and len(self.languages) > 1:
+            timings = self._build_locales_parallel(notes)
+        else:
+            timings = []
+            for lang in self.languages:
+                timings.append(self._build_locale(lang))
+
+                if lang == 'en-US':
+                    # 404 page for root accesses outside lang dirs.
+                    self._write_root_htaccess()
+                    if notes:
+                        with self.tracer.span('notes', 'notes'):
+                            self.build_notes()
+        if self.jobs > 1:
+            print_locale_timings(timings, time.perf_counter() - start, self.jobs)
+        self._finish_build(stage)
+
+
+# Site instance used by the current worker process, see _init_worker.
+_worker_site = None
+
+
+def _init_worker(site):
+    """Pool initializer, stores the (forked) `site` so every task in this worker reuses its Jinja2 environment."""
+    global _worker_site
+    _worker_site = site
+    # The spans and helper calls recorded before the fork are already in the parent's.
+    site.tracer.pop()
+    site.profiler.pop()
+
+
+def _build_locale_worker(lang):
+    """Pool task, builds a single locale with the worker's site. Returns its timing and results."""
+    timing = _worker_site._build_locale(lang)
+    return timing, _worker_site._pop_results()
+
+
+def _render_note_worker(context, outputs):
+    """Pool task, renders a single release note with the worker's site. Returns its results."""
+    _worker_site._render_note(context, outputs)
+    return _worker_site._pop_results()
+
+
+def print_minify_report(minified):
+    """Print the total bytes saved by minifying the pages in `minified` (path: (size, minified size)), and the top pages."""
+    size = sum(sizes[0] for sizes in minified.values())
+    saved = size - sum(sizes[1] for sizes in minified.values())
+    print("Minified {0} pages, saved {1} of {2} bytes ({3:.1%}):".format(len(minified), saved, size, saved / max(size, 1)))
+    for path, sizes in sorted(minified.items(), key=lambda item: item[1][0] - item[1][1], reverse=True)[:10]:
+        print("  {0:<60} {1:>8} bytes".format(path, sizes[0] - sizes[1]))
+
+
+def print_svg_report(inlined_svg):
+    """Print the bytes of inline svg in the pages in `inlined_svg` (path: bytes), in total and for the pages with the most."""
+    print("Inlined {0} bytes of svg in {1} pages:".format(sum(inlined_svg.values()), len(inlined_svg)))
+    for path, size in sorted(inlined_svg.items(), key=lambda item: item[1], reverse=True)[:10]:
+        print("  {0:<60} {1:>8} bytes".format(path, size))
+
+
+def print_trace_summary(events):
+    """Print the templates (summed over the locales) and locales that took the longest in the trace `events`."""
+    for category, title in (('render', 'templates'), ('locale', 'locales')):
+        slowest = tracing.slowest(events, category)
+        if not slowest:
+            continue
+        print("Slowest {0}:".format(title))
+        for name, count, total, longest in slowest:
+            print("  {0:<60} {1:>8.2f}s {2:>5}x, longest {3:.2f}s".format(name, total, count, longest))
+
+
+def print_helper_report(stats):
+    """Print the template helpers and filters that took the longest in the HelperProfiler `stats`, and where they're called from."""
+    print("Template helpers and filters by self time:")
+    print("  {0:<36} {1:>8} {2:>10} {3:>10}".format('helper', 'calls', 'total', 'self'))
+    for (name,), count, total, own in profiling.ranked(stats, ('helper',), 20):
+        print("  {0:<36} {1:>8} {2:>9.3f}s {3:>9.3f}s".format(name, count, total, own))
+    print("Slowest helpers by calling template:")
+    for (name, template), count, total, own in profiling.ranked(stats, ('helper', 'template'), 20):
+        print("  {0:<36} {1:<50} {2:>8} {3:>9.3f}s".format(name, str(template), count, own))
+
+
+def print_prune_report(pruned):
+    """Print the bytes removed from each css bundle in `pruned` (name: (size, pruned size)), and the total."""
+    size = sum(sizes[0] for sizes in pruned.values())
+    removed = size - sum(sizes[1] for sizes in pruned.values())
+    print("Pruned unused css from {0} bundles, removed {1} of {2} bytes ({3:.1%}):".format(
+        len(pruned), removed, size, removed / max(size, 1)))
+    for name, sizes in sorted(pruned.items(), key=lambda item: item[1][0] - item[1][1], reverse=True):
+        print("  {0:<30} {1:>8} of {2:>8} bytes".format(name + '.css', sizes[0] - sizes[1], sizes[0]))
+
+
+def print_locale_timings(timings, elapsed, jobs):
+    """Print the per-locale render `timings` (list of (lang, seconds)), slowest first."""
+    print("Rendered {0} locales in {1:.2f}s using {2} jobs:".format(len(timings), elapsed, jobs))
+    for lang, seconds in sorted(timings, key=lambda t: t[1], reverse=True):
+        print("  {0:<8} {1:.2f}s".format(lang, seconds))
 
 
 class UpdateHandler(FileSystemEventHandler):
@@ -507,7 +1383,8 @@ class UpdateHandler(FileSystemEventHandler):
     def updatesite(self, event):
         """Build the startpage or the website, ignoring assets or notes based on the `event`."""
         if self.builder.searchpath == settings.START_PATH:
-            self.builder.build_startpage()
+            # The HTTP server is serving from renderpath, so it can't be swapped out from under it.
+            self.builder.build_startpage(stage=False)
         else:
             # Reduce build time by ignoring release notes when unnecessary.
             if 'includes' in event.src_path:
@@ -521,7 +1398,14 @@ class UpdateHandler(FileSystemEventHandler):
         if delta.seconds > 0:
             timemsg = timestamp.strftime("%H:%M:%S")
             print("{0}: Starting update...".format(timemsg))
-            if settings.ASSETS in event.src_path:
+            # The memoized download buttons may include whatever changed.
+            helper.download_buttons.clear()
+            if self.builder.hash_assets and (settings.ASSETS in event.src_path or settings.MEDIA_URL[1:] in event.src_path):
+                # The hashed asset names change, so the pages referring to them have to be built again as well.
+                self.builder.build_assets()
+                self.updatesite(event)
+                print("{0}: Assets and website rebuilt.".format(datetime.datetime.now().strftime("%H:%M:%S")))
+            elif settings.ASSETS in event.src_path:
                 self.builder.partial_asset_build(event.src_path, timemsg)
             elif settings.MEDIA_URL[1:] in event.src_path:
                 self.builder.build_assets()
@@ -531,17 +1415,46 @@ class UpdateHandler(FileSystemEventHandler):
                 print("{0}: Website rebuilt.".format(datetime.datetime.now().strftime("%H:%M:%S")))
             self.updatetime = datetime.datetime.now()
 
+    def on_created(self, event):
+        """
+        Called by the watchdog observer when a file or directory is created. New templates and media files are added to
+        their indexes.
+        """
+        if event.src_path.startswith(self.builder.searchpath):
+            self.builder.templates.invalidate()
+        assets.media.add(event.src_path)
+        self.on_modified(event)
+
+    def on_deleted(self, event):
+        """
+        Called by the watchdog observer when a file or directory is deleted. Deleted templates and media files are removed
+        from their indexes.
+        """
+        if event.src_path.startswith(self.builder.searchpath):
+            self.builder.templates.invalidate()
+        svgstore.store.invalidate(event.src_path)
+        assets.media.discard(event.src_path)
+
+    def on_moved(self, event):
+        """Called by the watchdog observer when a file or directory is moved, which both deletes and creates a template."""
+        if event.src_path.startswith(self.builder.searchpath) or event.dest_path.startswith(self.builder.searchpath):
+            self.builder.templates.invalidate()
+        svgstore.store.invalidate(event.src_path)
+        svgstore.store.invalidate(event.dest_path)
+        assets.media.discard(event.src_path)
+        assets.media.add(event.dest_path)
+
     def on_modified(self, event):
         """This method is called by the watchdog observer by default when a file or directory is modified."""
-        from webassets.exceptions import BundleError
         standard_error_msg = 'An error has occurred during rendering !'
+        svgstore.store.invalidate(event.src_path)
 
         try:
             self.throttle_updates(datetime.datetime.now(), event)
         except IOError as err:
             print(standard_error_msg)
             print("{}: {} ({})\n".format(type(err).__name__, err.strerror, err.filename))
-        except BundleError as err:
+        except (assets.LessError, minify.MinifyError) as err:
             print(standard_error_msg)
             print("{}: {}\n".format(type(err).__name__, str(err)))
 
@@ -572,8 +1485,8 @@ def setup_httpd(port, path):
     os.chdir(path)
     handler = RedirectingHTTPRequestHandler
     httpd = TCPServer(("", port), handler)
-    multiprocessing.set_start_method("fork")
-    process = multiprocessing.Process(target=httpd.serve_forever)
+    # A fork context of its own, the default context is already set once the build has used a pool.
+    process = multiprocessing.get_context('fork').Process(target=httpd.serve_forever)
     process.daemon = True
     process.start()
     os.chdir(cwd)
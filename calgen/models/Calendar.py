@@ -2,6 +2,8 @@ from datetime import datetime, timedelta
 from enum import Enum
 import icalendar
 
+import buildcache
+
 
 class CalendarTypes(Enum):
     """ Note: National sets the calendary `transp` property to opaque. Every other type is transparent. """
@@ -46,12 +48,12 @@ class Calendar(object):
 
         data = {
             'uid': self.unique_id,
-            'last-modified': datetime.now(),
+            'last-modified': buildcache.build_time(),
             'dtstart': self.iso_date.date(),
             'dtend': self.iso_date.date() + timedelta(days=1),
             'summary': self.name,
             'description': self.description,
-            'dtstamp': datetime.now(),
+            'dtstamp': buildcache.build_time(),
             'class': 'public',
             'transp': 'opaque' if self.calendar_type == CalendarTypes.NATIONAL else 'transparent',
             'categories': ['Holidays'],
@@ -1,5 +1,7 @@
 from __future__ import unicode_literals
 
+import assets
+import buildcache
 import inspect
 import os
 from urllib.parse import urlparse
@@ -11,8 +13,8 @@ import markdown
 import markupsafe
 import re
 import settings
+import svgstore
 import sys
-import translate
 
 from babel.core import Locale, UnknownLocaleError
 from babel.dates import format_date
@@ -28,6 +30,14 @@ babel_format_locale_map = {
     'dsb': 'de',
 }
 
+# Rendered download buttons and the svg files they inline, by locale and the options of download_thunderbird. They only
+# depend on those, and on the templates, translations and product details, so the --watch observer clears them whenever
+# something changes.
+download_buttons = {}
+
+# Environment that renders the download buttons, created on first use. See download_thunderbird.
+download_button_env = None
+
 
 def load_calendar_json(json_file):
     calendars = []
@@ -47,7 +57,13 @@ def load_calendar_json(json_file):
 
 
 def static(filepath):
-    return path.join(settings.MEDIA_URL, filepath)
+    return assets.url(filepath)
+
+
+@jinja2.pass_context
+def js_bundle(ctx, name):
+    """Return the url of the js bundle `name`, split down to the files this page needs if the build splits bundles."""
+    return static('js/{0}.js'.format(assets.page_bundle(ctx.name, name)))
 
 
 @jinja2.pass_context
@@ -69,7 +85,7 @@ def url(ctx, key, *args):
 
 def _l10n_media_exists(type, locale, url):
     """ checks if a localized media file exists for the locale """
-    return path.exists(path.join(settings.MEDIA_URL.strip('/'), type, 'l10n', locale, url))
+    return assets.media.exists(path.join(type, 'l10n', locale, url))
 
 
 def add_string_to_image_url(url, addition):
@@ -189,8 +205,7 @@ def high_res_img(ctx, url, optional_attributes=None, scale='1.5x', alt_formats=(
 @jinja2.pass_context
 def svg(ctx, file_name):
     """Returns an inlined svg element, optionally (and by default) wraps a span around it to allow screen readers to ignore it."""
-    file = path.join(settings.MEDIA_URL.strip('/'), 'svg/' + file_name + '.svg')
-    return open(file).read()
+    return svgstore.store.inline(file_name)
 
 
 @jinja2.pass_context
@@ -213,7 +228,7 @@ def platform_img(ctx, url, optional_attributes=None):
         else:
             image = path.join('img', image)
 
-        if path.exists(path.join(settings.MEDIA_URL.strip('/'), image)):
+        if assets.media.exists(image):
             key = 'data-src-' + platform
             img_attrs[key] = static(image)
 
@@ -336,10 +351,17 @@ def download_thunderbird(ctx, channel='release', dom_id=None,
     :param hide_footer_links: Whether we should hide the footer links (System Requirements, What's New, Privacy Policy) display. Default to 'False'.
     :return: The button html.
     """
+    global download_button_env
     alt_channel = '' if channel == 'release' else channel
     locale = ctx.get('LANG', None)
     dom_id = dom_id or 'download-button-desktop-%s' % channel
 
+    key = (locale, channel, dom_id, force_direct, alt_copy, button_class, section, flex_class, hide_footer_links)
+    if key in download_buttons:
+        html, svgs = download_buttons[key]
+        svgstore.store.used.update(svgs)
+        return html
+
     l_version = thunderbird_desktop.latest_builds(locale, channel)
     if l_version:
         version, platforms = l_version
@@ -392,15 +414,20 @@ def download_thunderbird(ctx, channel='release', dom_id=None,
         'flex_class': flex_class,
         'hide_footer_links': hide_footer_links,
     }
-    loader = jinja2.FileSystemLoader(searchpath=settings.WEBSITE_PATH)
-    env = jinja2.Environment(loader=loader, extensions=['jinja2.ext.i18n'])
-    translator = translate.gettext_object(locale)
-    env.install_gettext_translations(translator)
-    env.globals.update(**ctx)
-    template = env.get_template('includes/download-button.html')
-
-    html = template.render(data)
-    return markupsafe.Markup(html)
+    if download_button_env is None:
+        loader = jinja2.FileSystemLoader(searchpath=settings.WEBSITE_PATH)
+        download_button_env = jinja2.Environment(loader=loader, extensions=['jinja2.ext.i18n'], bytecode_cache=buildcache.bytecode_cache())
+    # The environment keeps the compiled template, and reloads it if it changed. The translations and helpers come from
+    # the calling template's context, as they did when they were copied into a new environment for every button.
+    template = download_button_env.get_template('includes/download-button.html')
+
+    page_svgs, svgstore.store.used = svgstore.store.used, set()
+    try:
+        html = markupsafe.Markup(template.render(ctx.get_all(), **data))
+    finally:
+        svgs, svgstore.store.used = svgstore.store.used, page_svgs | svgstore.store.used
+    download_buttons[key] = (html, svgs)
+    return html
 
 
 def thunderbird_url(page, channel=None):
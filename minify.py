@@ -0,0 +1,77 @@
+import json
+import os
+import re
+import settings
+import subprocess
+import tempfile
+
+# Comments, elements whose contents must be kept as they are, and any other tag. Everything in between is text.
+HTML_TOKEN = re.compile(
+    r'<!--.*?-->|<({0})\b.*?</\1\s*>|</?[A-Za-z!][^>"\']*(?:(?:"[^"]*"|\'[^\']*\')[^>"\']*)*>'.format(
+        '|'.join(settings.MINIFY_PRESERVE_TAGS)),
+    re.DOTALL | re.IGNORECASE)
+
+# The comment terser appends to point at the source map, we write our own for the whole bundle.
+SOURCE_MAPPING_URL = re.compile(r'\n?//# sourceMappingURL=\S*\s*$')
+
+# Only ASCII whitespace, \s would also match (and collapse) non-breaking spaces.
+HTML_WHITESPACE = re.compile(r'[ \t\n\r\f]+')
+
+
+class MinifyError(Exception):
+    """Raised when terser fails to minify a js file."""
+
+
+def _collapse_whitespace(match):
+    # A run of whitespace renders as a single space, keep a line break if there was one to keep the source readable.
+    return '\n' if '\n' in match.group() else ' '
+
+
+def _is_conditional_comment(comment):
+    # e.g. <!--[if IE 9]> ... <![endif]--> and <!--<![endif]-->
+    return comment.startswith('<!--[') or comment.startswith('<!--<!')
+
+
+def minify_html(html):
+    """
+    Return `html` with comments removed and whitespace between tags and in text collapsed.
+    This only does what can't change how the page renders: tags and their attributes are kept as they are, and so are
+    conditional comments and the contents of the elements in `settings.MINIFY_PRESERVE_TAGS` (pre, script, inline svg...).
+    """
+    parts = []
+    text = []
+    position = 0
+    for match in HTML_TOKEN.finditer(html):
+        text.append(html[position:match.start()])
+        position = match.end()
+        token = match.group()
+        if token.startswith('<!--') and not _is_conditional_comment(token):
+            # Dropped, so the text around it is collapsed together.
+            continue
+        parts.append(HTML_WHITESPACE.sub(_collapse_whitespace, ''.join(text)))
+        parts.append(token)
+        text = []
+    text.append(html[position:])
+    parts.append(HTML_WHITESPACE.sub(_collapse_whitespace, ''.join(text)))
+    return ''.join(parts).strip()
+
+
+def minify_js(filepath):
+    """
+    Minify the js file `filepath` (relative to `settings.ASSETS`) with terser. Returns the code and its source map (dict),
+    which includes the original source.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        output = os.path.join(tmp, 'output.js')
+        try:
+            proc = subprocess.run([settings.TERSER_BIN, filepath, '--compress', '--mangle', '--output', output,
+                                   '--source-map', 'includeSources'], capture_output=True, cwd=settings.ASSETS)
+        except OSError:
+            raise MinifyError('Program file not found: {0}.'.format(settings.TERSER_BIN))
+        if proc.returncode:
+            raise MinifyError('{0}: {1}'.format(filepath, proc.stderr.decode('utf-8').strip()))
+        with open(output, 'r', encoding='utf-8') as f:
+            code = SOURCE_MAPPING_URL.sub('', f.read())
+        with open(output + '.map', 'r', encoding='utf-8') as f:
+            source_map = json.load(f)
+    return code, source_map
@@ -0,0 +1,91 @@
+import functools
+import jinja2.runtime
+import json
+import os
+import time
+
+# Fields of the keys the calls are recorded under.
+FIELDS = ('helper', 'template', 'lang')
+
+
+class HelperProfiler(object):
+    """
+    Counts the calls to the template helpers and filters, and the time spent in them, by the template they're called
+    from and the locale being built.
+    Helpers that take the context (jinja2.pass_context) are recorded under the template that calls them, which may be
+    an include, the others under the page being rendered (`page`).
+    Self time leaves out the time spent in other helpers called while the helper ran, e.g. by a template it renders.
+    """
+    def __init__(self):
+        # (count, total seconds, self seconds) by (helper, template, lang).
+        self.stats = {}
+        # (template, lang) of the page being rendered, set by the build.
+        self.page = (None, None)
+        self._nested = []
+
+    def wrap(self, name, func):
+        """
+        Return `func` recording its calls as the helper `name`. The wrapper keeps the attributes of `func`, so
+        jinja2.pass_context and the like still apply to it.
+        """
+        @functools.wraps(func)
+        def profiled(*args, **kwargs):
+            self._nested.append(0.0)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                nested = self._nested.pop()
+                if self._nested:
+                    self._nested[-1] += elapsed
+                template, lang = self.page
+                if args and isinstance(args[0], jinja2.runtime.Context):
+                    template = args[0].name
+                key = (name, template, lang)
+                count, total, own = self.stats.get(key, (0, 0.0, 0.0))
+                self.stats[key] = (count + 1, total + elapsed, own + elapsed - nested)
+        return profiled
+
+    def instrument(self, env, names):
+        """Replace the globals `names` and every filter of the Jinja2 `env` with wrappers recording their calls."""
+        for name in names:
+            if callable(env.globals.get(name)):
+                env.globals[name] = self.wrap(name, env.globals[name])
+        for name, func in list(env.filters.items()):
+            env.filters[name] = self.wrap('|' + name, func)
+
+    def pop(self):
+        """Return and clear the stats recorded so far, used to collect them from worker processes."""
+        stats, self.stats = self.stats, {}
+        return stats
+
+    def update(self, stats):
+        """Add the `stats` recorded elsewhere (e.g. a worker process) to ours."""
+        for key, (count, total, own) in stats.items():
+            previous = self.stats.get(key, (0, 0.0, 0.0))
+            self.stats[key] = (previous[0] + count, previous[1] + total, previous[2] + own)
+
+    def write(self, path):
+        """Write the stats to the json file `path`, as a list of records ranked by self time."""
+        records = [dict(zip(FIELDS, key), calls=count, total=total, self=own) for key, count, total, own in ranked(self.stats, FIELDS)]
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(records, f, indent=2)
+
+
+def ranked(stats, fields, limit=None):
+    """
+    Return the `stats` of a HelperProfiler summed by the key `fields` (some of FIELDS), as (key, count, total seconds,
+    self seconds) tuples ranked by self time.
+    """
+    indexes = [FIELDS.index(field) for field in fields]
+    totals = {}
+    for key, (count, total, own) in stats.items():
+        key = tuple(key[index] for index in indexes)
+        previous = totals.get(key, (0, 0.0, 0.0))
+        totals[key] = (previous[0] + count, previous[1] + total, previous[2] + own)
+    rows = sorted(totals.items(), key=lambda item: (-item[1][2], [str(part) for part in item[0]]))[:limit]
+    return [(key, count, total, own) for key, (count, total, own) in rows]
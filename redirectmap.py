@@ -0,0 +1,110 @@
+import logging
+import os
+import re
+import shutil
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+
+class RedirectMap(object):
+    """
+    Every redirect and 404 page of a site, which are also written to .htaccess files in many directories, collected into
+    one table for the web server. With it in the server config, per-directory overrides (AllowOverride) can be turned off.
+    Redirects are keyed by the url path of their directory, e.g. /en-US/download, and point to a url or, like an
+    .htaccess RewriteRule, a path that's served in its place. Like the .htaccess in that directory, a redirect applies to
+    everything under it too, the most specific one wins, e.g. /en-US/download/linux/ also goes to /en-US/thunderbird/all/.
+    404 pages are keyed by the url path they apply under.
+    Parameters:
+        `root` (str): Directory the site is rendered to, the paths we're given are relative to it.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.redirects = {}
+        self.not_found = {}
+
+    def _key(self, path):
+        key = os.path.relpath(path, self.root).replace(os.sep, '/')
+        return '/' if key == '.' else '/' + key
+
+    def redirect(self, path, url):
+        """Record that the directory (or file) `path` redirects to `url`."""
+        self.redirects[self._key(path)] = url
+
+    def error_page(self, path, page):
+        """Record that missing files under the directory `path` are answered with the 404 `page`."""
+        self.not_found[self._key(path)] = page
+
+    def pop(self):
+        """Return and clear the (redirects, not_found) recorded so far, used to collect them from worker processes."""
+        redirects, self.redirects = self.redirects, {}
+        not_found, self.not_found = self.not_found, {}
+        return redirects, not_found
+
+    def update(self, redirects, not_found):
+        """Merge `redirects` and `not_found` pages collected elsewhere (e.g. a worker process) into this map."""
+        self.redirects.update(redirects)
+        self.not_found.update(not_found)
+
+    def rewrite_map(self):
+        """Return the redirects as an Apache RewriteMap txt file."""
+        return ''.join('{0} {1}\n'.format(key, url) for key, url in sorted(self.redirects.items()))
+
+    def _depths(self):
+        """Return the numbers of path segments of the redirects, most first."""
+        return sorted({key.count('/') for key in self.redirects if key != '/'}, reverse=True)
+
+    def apache_conf(self, map_name='redirects'):
+        """
+        Return an Apache config include of the rewrite rules that look up the redirects in the RewriteMap `map_name`, and
+        the 404 pages. The rules look up the first path segments of the request, the most segments first, and like the
+        .htaccess RewriteRule .* send everything under a redirected directory to its url.
+        """
+        sections = []
+        for depth in self._depths():
+            sections.append('RewriteCond "${{{0}:$1}}" !=""\n'
+                            'RewriteRule "^((?:/[^/]+){{{1}}})(?:/.*)?$" "${{{0}:$1}}" [L]\n'.format(map_name, depth))
+        for key, page in sorted(self.not_found.items()):
+            sections.append('<Location "{0}">\n    ErrorDocument 404 {1}\n</Location>\n'.format(key, page))
+        return ''.join(sections)
+
+    def nginx_conf(self, name):
+        """
+        Return an nginx include of the maps from the request $uri to the redirect ($`name`_redirect) and the 404 page
+        ($`name`_not_found). Redirects match their path and everything under it.
+        """
+        lines = ['map $uri ${0}_redirect {{'.format(name),
+                 '    default "";']
+        # nginx uses the first regex that matches, so the paths with the most segments go first.
+        for key, url in sorted(self.redirects.items(), key=lambda item: (-item[0].count('/'), item[0])):
+            if key == '/':
+                continue
+            lines.append('    "~^{0}(?:/.*)?$" "{1}";'.format(re.escape(key), url))
+        lines.extend(['}', '', 'map $uri ${0}_not_found {{'.format(name)])
+        # nginx uses the first regex that matches, so the longest paths go first.
+        for key, page in sorted(self.not_found.items(), key=lambda item: (-len(item[0]), item[0])):
+            if key == '/':
+                lines.append('    default "{0}";'.format(page))
+            else:
+                lines.append('    "~^{0}/" "{1}";'.format(key.rstrip('/'), page))
+        lines.append('}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, directory, name, write):
+        """
+        Write the tables for the site `name` to `directory`, using `write(path, content)`: the RewriteMap as name.txt
+        (and name.dbm, if Apache's httxt2dbm is installed), the rules that look it up and the 404 pages as name.apache.conf
+        and both as name.nginx.conf.
+        """
+        os.makedirs(directory, exist_ok=True)
+        txt = os.path.join(directory, name + '.txt')
+        changed = write(txt, self.rewrite_map())
+        write(os.path.join(directory, name + '.apache.conf'), self.apache_conf())
+        write(os.path.join(directory, name + '.nginx.conf'), self.nginx_conf(name.replace('.', '_').replace('-', '_')))
+
+        httxt2dbm = shutil.which('httxt2dbm')
+        dbm = os.path.join(directory, name + '.dbm')
+        if httxt2dbm is None:
+            logger.info("httxt2dbm isn't installed, not writing {0}.".format(dbm))
+        elif changed or not os.path.exists(dbm + '.pag'):
+            subprocess.run([httxt2dbm, '-i', txt, '-o', dbm], check=True, capture_output=True)
@@ -114,6 +114,18 @@ WIKI_URL = 'https://wiki.mozilla.org'
 # path for assets that need processing, like LESS and js
 ASSETS = 'assets'
 
+# lessc binary used to compile the css bundles.
+LESS_BIN = 'lessc'
+
+# node script that keeps less loaded between compiles, set to None to start lessc for every file instead.
+LESS_WORKER = 'tools/less-worker.js'
+
+# node binary that runs the LESS_WORKER.
+NODE_BIN = 'node'
+
+# terser binary used to minify the js bundles with --minify, they're only concatenated if it isn't installed.
+TERSER_BIN = 'terser'
+
 # base url for media files
 MEDIA_URL = '/media'
 
@@ -135,6 +147,66 @@ START_RENDERPATH = 'dist/start.thunderbird.net'
 
 LOCALE_PATH = 'libs/locale'
 
+# path for state kept between builds, like the build manifest used for incremental builds.
+BUILD_CACHE_PATH = '.buildcache'
+
+# size cap in bytes of the Jinja2 bytecode cache kept in BUILD_CACHE_PATH, least recently used templates are evicted first.
+BYTECODE_CACHE_MAX_SIZE = 32 * 1024 * 1024
+
+# json report of the outputs added, changed and removed by the last build, written to the root of the renderpath.
+BUILD_CHANGES_FILE = '.build-changes.json'
+
+# Text outputs that get precompressed .gz (and with the brotli package installed, .br) siblings, by extension, mapped to
+# the content type the siblings are served as.
+PRECOMPRESS_TYPES = {
+    '.html': 'text/html',
+    '.css': 'text/css',
+    '.js': 'text/javascript',
+    '.xml': 'application/xml',
+    '.ics': 'text/calendar',
+    '.json': 'application/json',
+    '.svg': 'image/svg+xml',
+    '.txt': 'text/plain',
+}
+
+# Outputs smaller than this many bytes aren't worth precompressing.
+PRECOMPRESS_MIN_SIZE = 512
+
+# Number of hex digits of the content hash in hashed asset names, e.g. css/base-style.0123456789.css
+ASSET_HASH_LENGTH = 10
+
+# json manifest of the hashed asset names, written to the media directory of the renderpath.
+ASSET_MANIFEST = 'assets.json'
+
+# Class names and ids (regular expressions) that --prune-css keeps the css rules of, even if no page or script contains
+# them. Anything that's written out in the html, inline scripts or js files is found without being listed here.
+CSS_PRUNE_ALLOWLIST = (
+    # The architecture site.js takes from the user agent and adds to the classes of <html>, e.g. armv7
+    r'arm\w*',
+)
+
+# Pages that get the css they need to render their first CRITICAL_CSS_FOLD characters inlined with --critical-css, by site
+# (the directory of its templates), as patterns of their template names. The rest of the css loads without blocking.
+CRITICAL_CSS_PAGES = {
+    'www.thunderbird.net': ('index.html', 'download/index.html', 'thunderbird/all/index.html'),
+    'start.thunderbird.net': ('*',),
+}
+
+# How far into the html of a page, after <body, counts as above the fold for --critical-css.
+CRITICAL_CSS_FOLD = 12000
+
+# size cap in bytes of the --critical-css cache kept in BUILD_CACHE_PATH, least recently used pages are evicted first.
+CRITICAL_CSS_CACHE_MAX_SIZE = 8 * 1024 * 1024
+
+# json manifest of the bundles every page uses with --split-bundles, written to the media directory of the renderpath.
+BUNDLE_MANIFEST = 'bundles.json'
+
+# max-age in seconds of the hashed assets, which never change.
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# Elements whose contents are kept exactly as they are when minifying html.
+MINIFY_PRESERVE_TAGS = ('pre', 'textarea', 'code', 'script', 'style', 'svg')
+
 CALDATA_URL = MEDIA_URL + '/caldata/'
 
 CALDATA_AUTOGEN_URL = 'media/caldata/autogen/'
@@ -149,6 +221,9 @@ USE_APPLE_PAY_DOMAIN_VERIFICATION = True
 # path to product-details json files
 JSON_PATH = 'libs/product-details/public/1.0'
 
+# git checkouts (or paths inside them) whose newest commit time is used for all timestamps of --reproducible builds.
+SOURCE_DATE_PATHS = ['.', LOCALE_PATH, 'libs/thunderbird_notes', JSON_PATH]
+
 ALL_PLATFORMS = ('windows', 'linux', 'mac')
 
 # Mappings for the helper.url function.
@@ -307,6 +382,16 @@ START_JS = {
     ]
 }
 
+# js bundle files that only some pages need, with what a page's templates contain when they do: the names of helpers
+# they call, or strings in their source such as the ids the script looks for. With --split-bundles a page only gets the
+# listed files it needs, every file that isn't listed is always included.
+JS_MODULE_USAGE = {
+    'js/common/autodownload.js': ('thunderbird-download',),
+    'js/common/beta-appeal.js': ('thunderbird-beta-appeal',),
+    'js/common/download.js': ('download-release-select',),
+    'js/common/mozilla-image-helper.js': ('platform_img', 'platform-img'),
+}
+
 CURRENCIES = {
     # Second value is the default.
     'brl': {'symbol': 'R$', 'presets': ['80', '40', '20', '10'], 'default': '40'},
@@ -490,6 +575,12 @@ CALENDAR_REMAP = {
     'United States': 'US'
 }
 
+# Decimal places the numbers in the paths of inlined svg files are rounded to by --optimize-svg.
+SVG_PRECISION = 3
+
+# Directory the consolidated redirect tables of the sites are written to, outside of what's served. See redirectmap.py.
+REDIRECT_MAP_PATH = 'dist/redirects'
+
 # Filter out specific versions for the release notes page
 VERSIONS_TO_FILTER = []
 
@@ -0,0 +1,214 @@
+import re
+import settings
+import urllib.parse
+
+# Strings and comments, which may contain braces or semicolons that don't end a rule.
+CSS_SKIP = re.compile(r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'|/\*.*?\*/', re.DOTALL)
+
+# Whitespace and comments between rules.
+CSS_SPACE = re.compile(r'\s+|/\*.*?\*/', re.DOTALL)
+
+# At-rules whose blocks contain style rules, which are pruned like the top level ones. The blocks of other at-rules, like
+# @font-face and @keyframes, are kept as they are.
+NESTING_AT_RULES = ('@media', '@supports', '@document', '@layer', '@container')
+
+# Class and id selectors, names may contain escaped characters like .md\:flex
+SELECTOR_NAME = re.compile(r'[.#]((?:[\w-]|\\.)+)')
+
+# Attribute selectors and the arguments of functional pseudo-classes such as :not(.a), a missing class in them doesn't
+# mean the selector matches nothing.
+SELECTOR_IGNORED = re.compile(r'\[[^\]]*\]|\([^()]*\)')
+
+# class and id attributes of html elements, and the contents of inline scripts.
+HTML_NAMES = re.compile(r'''\s(?:class|id)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))|<script\b[^>]*>(.*?)</script\s*>''',
+                        re.DOTALL | re.IGNORECASE)
+
+# <link> tags, and their url.
+LINK_TAG = re.compile(r'<link\b[^>]*>', re.IGNORECASE)
+LINK_HREF = re.compile(r'''\bhref\s*=\s*["']([^"']+)["']''')
+
+# url() references in css.
+CSS_URL = re.compile(r'''url\(\s*(["']?)([^"')]+)\1\s*\)''')
+
+# Loads a stylesheet without blocking rendering, it's applied once it has loaded.
+ASYNC_STYLESHEET = ('''<link rel="preload" href="{0}" as="style" onload="this.onload=null;this.rel='stylesheet'">'''
+                    '''<noscript><link rel="stylesheet" href="{0}"></noscript>''')
+
+# Anything in a script that could be a class name or id it adds to the page.
+SCRIPT_WORD = re.compile(r'[A-Za-z_][\w-]*')
+
+
+def _find_end(css, position, stop):
+    """Return the index of the first of the characters in `stop` in `css` from `position` on, skipping strings and comments."""
+    while position < len(css):
+        if css[position] in stop:
+            return position
+        match = CSS_SKIP.match(css, position)
+        position = match.end() if match else position + 1
+    return position
+
+
+def _find_block_end(css, position):
+    """Return the index of the } that closes the block starting at `position` (just after its {), or the end of `css`."""
+    depth = 1
+    while depth:
+        position = _find_end(css, position, '{}')
+        if position == len(css):
+            return position
+        depth += 1 if css[position] == '{' else -1
+        position += 1
+    return position - 1
+
+
+def parse_rules(css):
+    """
+    Split `css` into its top level rules. Yields (prelude, block) tuples, where the prelude is the selector list or
+    at-rule before the block, and block is None for statements such as @import. Comments and the whitespace between
+    rules are yielded as preludes without a block, so joining everything back together gives the original `css`.
+    """
+    position = 0
+    while position < len(css):
+        skipped = CSS_SPACE.match(css, position)
+        if skipped:
+            yield skipped.group(), None
+            position = skipped.end()
+            continue
+        end = _find_end(css, position, '{;}')
+        if end == len(css) or css[end] != '{':
+            yield css[position:end + 1], None
+            position = end + 1
+            continue
+        block_end = _find_block_end(css, end + 1)
+        yield css[position:end], css[end + 1:block_end]
+        position = block_end + 1
+
+
+def split_selectors(prelude):
+    """Split the selector list `prelude` on its top level commas."""
+    selectors = []
+    depth = 0
+    start = 0
+    for index, char in enumerate(prelude):
+        if char in '([':
+            depth += 1
+        elif char in ')]':
+            depth -= 1
+        elif char == ',' and not depth:
+            selectors.append(prelude[start:index])
+            start = index + 1
+    selectors.append(prelude[start:])
+    return selectors
+
+
+def selector_names(selector):
+    """Return the class names and ids `selector` requires an element to have."""
+    previous = None
+    while previous != selector:
+        previous, selector = selector, SELECTOR_IGNORED.sub('', selector)
+    return {re.sub(r'\\(.)', r'\1', name) for name in SELECTOR_NAME.findall(selector)}
+
+
+def used_names(text, script=False):
+    """
+    Return the class names and ids used by the html `text`: those in class and id attributes, and anything in inline
+    scripts that could be one. With `script` the `text` is a js file, and every word in it is returned.
+    """
+    if script:
+        return set(SCRIPT_WORD.findall(text))
+    names = set()
+    for match in HTML_NAMES.finditer(text):
+        if match.group(4) is not None:
+            names.update(SCRIPT_WORD.findall(match.group(4)))
+        else:
+            names.update((match.group(1) or match.group(2) or match.group(3) or '').split())
+    return names
+
+
+def file_names(path):
+    """Return the class names and ids used by the html or js file at `path`, see used_names."""
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        return used_names(f.read(), script=path.endswith('.js'))
+
+
+def prune_css(css, used):
+    """
+    Return `css` without the style rules that can't match anything: rules whose selectors all need a class or id that
+    isn't in `used`, and doesn't match any of the patterns in `settings.CSS_PRUNE_ALLOWLIST`. Selectors are only
+    removed from the rules that are kept if they can't match either. Everything else is kept as it is.
+    """
+    allowed = re.compile('|'.join(settings.CSS_PRUNE_ALLOWLIST) or '(?!)')
+
+    def is_used(selector):
+        return all(name in used or allowed.fullmatch(name) for name in selector_names(selector))
+
+    parts = []
+    for prelude, block in parse_rules(css):
+        if block is None:
+            parts.append(prelude)
+            continue
+        if prelude.startswith('@'):
+            if re.match(r'@[\w-]+', prelude).group().lower() in NESTING_AT_RULES:
+                block = prune_css(block, used)
+            rule = '{0}{{{1}}}'.format(prelude, block) if block.strip() else None
+        else:
+            selectors = [selector for selector in split_selectors(prelude) if is_used(selector)]
+            rule = '{0}{{{1}}}'.format(','.join(selectors), block) if selectors else None
+        if rule is not None:
+            parts.append(rule)
+        elif parts and not parts[-1].strip():
+            # Drop the whitespace before a removed rule along with it.
+            parts.pop()
+    return ''.join(parts)
+
+
+def above_the_fold(html, fold):
+    """Return the start of `html` up to `fold` characters into its body, which is what's rendered first."""
+    body = re.search(r'<body\b', html, re.IGNORECASE)
+    return html[:(body.start() if body else 0) + fold]
+
+
+def rebase_urls(css, base):
+    """Return `css` with its relative urls made relative to the page instead, `base` is the url of the stylesheet."""
+    def rebase(match):
+        url = match.group(2)
+        if re.match(r'[a-z][\w+.-]*:|/|#', url, re.IGNORECASE):
+            return match.group()
+        return 'url({0}{1}{0})'.format(match.group(1), urllib.parse.urljoin(base, url))
+    return CSS_URL.sub(rebase, css)
+
+
+def critical_css(css, html, fold):
+    """
+    Return the rules of `css` that can match the elements above the `fold` of `html`, see above_the_fold. The @import
+    and @charset statements are left out, the whole stylesheet still loads after the page is rendered.
+    """
+    css = prune_css(css, used_names(above_the_fold(html, fold)))
+    return ''.join(prelude + ('{' + block + '}' if block is not None else '') for prelude, block in parse_rules(css)
+                   if not re.match('@(import|charset)', prelude, re.IGNORECASE)).strip()
+
+
+def stylesheet_links(html, names):
+    """Return the (link tag, url, name) of the <link rel="stylesheet"> tags in the head of `html` loading a css bundle in `names`."""
+    head = html[:html.find('</head>')] if '</head>' in html else html
+    links = []
+    for tag in LINK_TAG.findall(head):
+        href = LINK_HREF.search(tag)
+        if not href or 'stylesheet' not in tag:
+            continue
+        name = re.search(r'css/([\w-]+)(?:\.[0-9a-f]{{{0}}})?\.css$'.format(settings.ASSET_HASH_LENGTH), href.group(1))
+        if name and name.group(1) in names:
+            links.append((tag, href.group(1), name.group(1)))
+    return links
+
+
+def inline_critical_css(html, links, critical):
+    """
+    Return `html` with the `critical` css inlined where the first of the stylesheet `links` (see stylesheet_links)
+    was, and every one of them loaded without blocking rendering.
+    """
+    for index, (tag, url, name) in enumerate(links):
+        markup = ASYNC_STYLESHEET.format(url)
+        if not index:
+            markup = '<style>{0}</style>\n{1}'.format(critical.replace('</', '<\\/'), markup)
+        html = html.replace(tag, markup, 1)
+    return html
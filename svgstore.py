@@ -0,0 +1,158 @@
+import os
+import re
+import settings
+
+# Parts of svg files that don't change how they're displayed inline: the xml declaration, doctype, comments, metadata and
+# the elements and attributes of the editors that saved them.
+SVG_UNUSED = re.compile(r'<\?xml.*?\?>|<!DOCTYPE[^>]*>|<!--.*?-->|<metadata\b.*?</metadata\s*>|<metadata\b[^>]*/>|'
+                        r'<(sodipodi|inkscape):([\w-]+)\b(?:[^>]*/>|.*?</\1:\2\s*>)', re.DOTALL | re.IGNORECASE)
+SVG_UNUSED_ATTRIBUTE = re.compile(r'\s+(?:xmlns:)?(?:sodipodi|inkscape)(?::[\w-]+)?\s*=\s*"[^"]*"')
+
+# Start and end tags, and the whitespace between them.
+SVG_TAG = re.compile(r'<[^>]+>')
+SVG_BETWEEN_TAGS = re.compile(r'>\s+<')
+
+# Path data and point lists, whose numbers are rounded.
+SVG_COORDINATES = re.compile(r'(\s(?:d|points)\s*=\s*")([^"]*)(")')
+SVG_DECIMAL = re.compile(r'-?\d*\.\d+(?![\d.]*e)')
+
+# The root element of an svg file, and its contents.
+SVG_ROOT = re.compile(r'<svg\b([^>]*)>(.*)</svg\s*>', re.DOTALL | re.IGNORECASE)
+SVG_VIEWPORT_ATTRIBUTE = re.compile(r'\s(?:viewBox|preserveAspectRatio)\s*=\s*"[^"]*"')
+
+# Inline svg elements in html.
+INLINE_SVG = re.compile(r'<svg\b.*?</svg\s*>', re.DOTALL | re.IGNORECASE)
+
+
+def round_coordinates(data, precision):
+    """Return the path data or point list `data` with its decimal numbers rounded to `precision` digits."""
+    def rounded(match):
+        number = '{0:.{1}f}'.format(float(match.group()), precision).rstrip('0').rstrip('.')
+        if number == '-0':
+            number = '0'
+        number = re.sub(r'^(-?)0\.', r'\1.', number)
+        # Path data may leave out the separator before a number starting with a dot, as in 1.5.5
+        if '.' not in number and match.end() < len(data) and data[match.end()] == '.':
+            number += ' '
+        return number
+    return SVG_DECIMAL.sub(rounded, data)
+
+
+def optimize_svg(markup, precision=None):
+    """
+    Return the svg `markup` without what isn't needed to display it inline (see SVG_UNUSED), with the whitespace in and
+    between its tags collapsed and the numbers of its paths rounded to `precision` (`settings.SVG_PRECISION`) digits.
+    """
+    if precision is None:
+        precision = settings.SVG_PRECISION
+    markup = SVG_UNUSED.sub('', markup)
+
+    def collapse(match):
+        tag = SVG_UNUSED_ATTRIBUTE.sub('', match.group())
+        tag = SVG_COORDINATES.sub(lambda m: m.group(1) + round_coordinates(m.group(2), precision) + m.group(3), tag)
+        tag = re.sub(r'\s+', ' ', tag)
+        return re.sub(r'\s*(/?>)$', r'\1', tag)
+
+    markup = SVG_TAG.sub(collapse, markup)
+    return SVG_BETWEEN_TAGS.sub('><', markup).strip()
+
+
+def symbol_id(name):
+    """Return the id of the <symbol> of the svg file `name`."""
+    return 'svg-symbol-' + re.sub(r'[^\w-]', '-', name)
+
+
+def symbol_markup(markup, name):
+    """
+    Return the (first, later) markup of the svg file `name` for a page that inlines it more than once: the first defines
+    its contents as a <symbol> and uses it, the later ones only use it. Both keep the attributes of its root element.
+    Returns None if the root element isn't found.
+    """
+    match = SVG_ROOT.search(markup)
+    if match is None:
+        return None
+    attributes, contents = match.groups()
+    viewport = ''.join(SVG_VIEWPORT_ATTRIBUTE.findall(attributes))
+    use = '<use href="#{0}"/>'.format(symbol_id(name))
+    first = '<svg{0}><symbol id="{1}"{2}>{3}</symbol>{4}</svg>'.format(attributes, symbol_id(name), viewport, contents, use)
+    return first, '<svg{0}>{1}</svg>'.format(attributes, use)
+
+
+def inlined_bytes(html):
+    """Return the size in bytes of the svg elements inlined in `html`."""
+    return sum(len(match.group().encode('utf-8')) for match in INLINE_SVG.finditer(html))
+
+
+class SvgStore(object):
+    """
+    The svg files inlined by helper.svg, each read once per process and kept in memory. The --watch observer drops the
+    files that change, they're read again the next time they're inlined.
+    Parameters:
+        `directory` (str): Directory of the svg files.
+    Attributes:
+        `optimize` (bool): Optimize the files as they're read, see optimize_svg.
+        `symbols` (bool): Inline the contents of a file only once per page, see end_page.
+        `used` (set): Names of the files inlined in the page being rendered.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.optimize = False
+        self.symbols = False
+        self.files = {}
+        self.used = set()
+
+    def get(self, name):
+        """Return the markup of the svg file `name`, e.g. base/icons/close for <directory>/base/icons/close.svg"""
+        markup = self.files.get(name)
+        if markup is None:
+            with open(os.path.join(self.directory, name + '.svg'), 'r', encoding='utf-8') as f:
+                markup = f.read()
+            if self.optimize:
+                markup = optimize_svg(markup)
+            self.files[name] = markup
+        return markup
+
+    def inline(self, name):
+        """Return the markup of the svg file `name`, and record that it's inlined in the page being rendered."""
+        self.used.add(name)
+        return self.get(name)
+
+    def begin_page(self):
+        """Start recording the files inlined in a page."""
+        self.used = set()
+
+    def end_page(self, html):
+        """
+        Return the rendered page `html`. With `symbols`, the files it inlines more than once are turned into a <symbol>
+        where they're first inlined, and everywhere else into a <use> of it.
+        """
+        if not self.symbols:
+            return html
+        for name in sorted(self.used):
+            markup = self.get(name)
+            if html.count(markup) < 2:
+                continue
+            symbol = symbol_markup(markup, name)
+            if symbol is not None:
+                first, later = symbol
+                html = html.replace(markup, first, 1).replace(markup, later)
+        return html
+
+    def invalidate(self, path):
+        """Forget the file at `path`, or every file if `path` is a directory that contains svg files."""
+        path = os.path.abspath(path)
+        directory = os.path.abspath(self.directory)
+        if os.path.commonpath([path, directory]) not in (path, directory):
+            return
+        if path != directory and path.endswith('.svg'):
+            self.files.pop(os.path.relpath(path, directory)[:-len('.svg')].replace(os.sep, '/'), None)
+        else:
+            self.clear()
+
+    def clear(self):
+        """Forget every file."""
+        self.files = {}
+
+
+# The store used by helper.svg.
+store = SvgStore(os.path.join(settings.MEDIA_URL.strip('/'), 'svg'))
@@ -0,0 +1,143 @@
+import os
+
+import assets
+import builder
+import settings
+
+
+class TestHashMedia:
+    def test_hash_media(self, tmp_path):
+        """Ensure every media file gets a hashed name next to it, and hashing again doesn't hash the hashed names."""
+        (tmp_path / 'css').mkdir()
+        (tmp_path / 'css' / 'base.css').write_text('body {}')
+        (tmp_path / 'js').mkdir()
+        (tmp_path / 'js' / 'site-bundle.js').write_text('var a;')
+
+        manifest = assets.hash_media(str(tmp_path))
+        assert sorted(manifest) == [os.path.join('css', 'base.css'), os.path.join('js', 'site-bundle.js')]
+        hashed = tmp_path / manifest[os.path.join('css', 'base.css')]
+        assert hashed.read_text() == 'body {}'
+        assert len(hashed.name.split('.')[1]) == settings.ASSET_HASH_LENGTH
+
+        assert assets.hash_media(str(tmp_path)) == manifest
+
+    def test_hash_media_manifest(self, tmp_path, monkeypatch):
+        """Ensure the hashed names are build outputs, unchanged files aren't hashed again and old names become stale."""
+        media = tmp_path / 'media'
+        media.mkdir()
+        (media / 'a.css').write_text('a {}')
+        (media / 'b.css').write_text('b {}')
+        build_manifest = assets.buildcache.BuildManifest(str(tmp_path / 'manifest.json'), str(tmp_path))
+        manifest = assets.hash_media(str(media), build_manifest)
+        assert build_manifest.changes()['added'] == sorted(os.path.join('media', manifest[name]) for name in manifest)
+        build_manifest.save(full=True)
+
+        hashed = []
+        hash_file = assets.buildcache.hash_file
+        monkeypatch.setattr(assets.buildcache, 'hash_file', lambda path: hashed.append(path) or hash_file(path))
+        (media / 'b.css').write_text('b { color: red }')
+        changed = assets.hash_media(str(media), build_manifest)
+        assert hashed == [str(media / 'b.css')]
+        assert changed['a.css'] == manifest['a.css']
+        assert build_manifest.stale() == [os.path.join('media', manifest['b.css'])]
+
+    def test_hash_media_precompressed(self, tmp_path, monkeypatch):
+        """Ensure the precompressed siblings written after the first build aren't hashed by the next one."""
+        monkeypatch.setattr(settings, 'PRECOMPRESS_MIN_SIZE', 0)
+        (tmp_path / 'js').mkdir()
+        (tmp_path / 'js' / 'calendar.js').write_text('var calendar;')
+        precompressed = [suffix for suffix, encoding, compress in builder.PRECOMPRESSORS]
+        manifest = assets.hash_media(str(tmp_path), precompressed=precompressed)
+        for dirpath, dirnames, filenames in os.walk(str(tmp_path)):
+            for filename in filenames:
+                builder.precompress_file(os.path.join(dirpath, filename))
+        files = sorted(os.listdir(tmp_path / 'js'))
+
+        assert assets.hash_media(str(tmp_path), precompressed=precompressed) == manifest
+        assert sorted(manifest) == [os.path.join('js', 'calendar.js')]
+        assert sorted(os.listdir(tmp_path / 'js')) == files
+
+    def test_url(self, monkeypatch):
+        """Ensure urls use the hashed name if there is one."""
+        monkeypatch.setattr(assets, 'manifest', {'css/base.css': 'css/base.0123456789.css'})
+        assert assets.url('css/base.css') == settings.MEDIA_URL + '/css/base.0123456789.css'
+        assert assets.url('img/logo.png') == settings.MEDIA_URL + '/img/logo.png'
+
+    def test_page_bundle(self, monkeypatch):
+        """Ensure pages use their split bundle if they have one, and the full bundle otherwise."""
+        monkeypatch.setattr(assets, 'bundles', {'index.html': {'common-bundle': 'common-bundle-0123abcd'}})
+        assert assets.page_bundle('index.html', 'common-bundle') == 'common-bundle-0123abcd'
+        assert assets.page_bundle('index.html', 'site-bundle') == 'site-bundle'
+        assert assets.page_bundle('thunderbird/all/index.html', 'common-bundle') == 'common-bundle'
+
+
+class TestMediaIndex:
+    def test_exists(self, tmp_path):
+        """Ensure files and directories are found, and the index follows created and deleted files."""
+        (tmp_path / 'img' / 'l10n' / 'fr').mkdir(parents=True)
+        (tmp_path / 'img' / 'l10n' / 'fr' / 'a.png').write_bytes(b'')
+        media = assets.MediaIndex(str(tmp_path))
+        assert media.exists('img/l10n/fr/a.png')
+        assert media.exists(os.path.join('img', 'l10n', 'fr'))
+        assert not media.exists('img/l10n/de/a.png')
+
+        (tmp_path / 'img' / 'l10n' / 'de').mkdir()
+        (tmp_path / 'img' / 'l10n' / 'de' / 'a.png').write_bytes(b'')
+        assert not media.exists('img/l10n/de/a.png')
+        media.add(str(tmp_path / 'img' / 'l10n' / 'de'))
+        assert media.exists('img/l10n/de/a.png')
+
+        media.discard(str(tmp_path / 'img' / 'l10n' / 'fr'))
+        assert not media.exists('img/l10n/fr/a.png')
+        assert not media.exists('img/l10n/fr')
+        assert media.exists('img/l10n')
+
+
+class TestLessImportGraph:
+    def test_closure(self, tmp_path, monkeypatch):
+        """Ensure the closure follows imports transitively, relative to the importing file, and sees changed imports."""
+        monkeypatch.setattr(settings, 'ASSETS', str(tmp_path))
+        (tmp_path / 'less' / 'new').mkdir(parents=True)
+        (tmp_path / 'less' / 'base.less').write_text('@import "new/colours";\n@import (reference) \'mixins.less\';')
+        (tmp_path / 'less' / 'mixins.less').write_text('')
+        (tmp_path / 'less' / 'new' / 'colours.less').write_text('@import "../fonts.less";')
+        (tmp_path / 'less' / 'fonts.less').write_text('')
+        (tmp_path / 'less' / 'other.less').write_text('')
+
+        graph = assets.LessImportGraph(str(tmp_path / 'cache' / 'graph.json'))
+        closure = graph.closure([os.path.join('less', 'base.less')])
+        assert closure == sorted(os.path.join('less', name) for name in
+                                 ('base.less', 'mixins.less', os.path.join('new', 'colours.less'), 'fonts.less'))
+
+        graph.save()
+        base = tmp_path / 'less' / 'base.less'
+        base.write_text('@import "other";')
+        os.utime(base, ns=(0, 0))
+        graph = assets.LessImportGraph(str(tmp_path / 'cache' / 'graph.json'))
+        assert graph.closure([os.path.join('less', 'base.less')]) == [os.path.join('less', 'base.less'),
+                                                                       os.path.join('less', 'other.less')]
+
+
+class TestBuildJsBundle:
+    def test_minified(self, tmp_path, monkeypatch):
+        """Ensure each file is minified once, and the index map has a section at the line each minified file starts."""
+        monkeypatch.setattr(settings, 'ASSETS', str(tmp_path))
+        minified = []
+
+        def minify_js(filepath):
+            minified.append(filepath)
+            return 'min({0});'.format(filepath), {'version': 3, 'sources': [filepath]}
+        monkeypatch.setattr(assets.minify, 'minify_js', minify_js)
+        (tmp_path / 'lib.min.js').write_text('lib();\nlib();')
+        (tmp_path / 'a.js').write_text('a();')
+        (tmp_path / 'b.js').write_text('b();')
+        cache = assets.buildcache.FileCache(str(tmp_path / 'cache'), '.json')
+
+        js, source_map = assets.build_js_bundle(['lib.min.js', 'a.js', 'b.js'], cache, terser='terser')
+        assert js == 'lib();\nlib();\nmin(a.js);\nmin(b.js);'
+        assert [section['offset']['line'] for section in source_map['sections']] == [2, 3]
+        assert source_map['sections'][1]['map']['sources'] == ['b.js']
+
+        (tmp_path / 'b.js').write_text('b(1);')
+        assert assets.build_js_bundle(['lib.min.js', 'a.js', 'b.js'], cache, terser='terser')[0] == js
+        assert sorted(minified) == ['a.js', 'b.js', 'b.js']
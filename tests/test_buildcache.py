@@ -0,0 +1,138 @@
+import os
+import threading
+
+import jinja2
+
+import buildcache
+
+
+class TestBuildManifest:
+    def test_is_fresh(self, tmp_path):
+        """Ensure an output is only fresh if it still exists and its inputs are unchanged."""
+        output = tmp_path / 'en-US' / 'index.html'
+        output.parent.mkdir()
+        output.write_text('<html></html>')
+        manifest_path = str(tmp_path / 'manifest.json')
+
+        manifest = buildcache.BuildManifest(manifest_path, str(tmp_path))
+        assert not manifest.is_fresh(str(output), {'template:index.html': 'a'})
+        manifest.record(str(output), {'template:index.html': 'a'})
+        manifest.save()
+
+        manifest = buildcache.BuildManifest(manifest_path, str(tmp_path))
+        assert manifest.is_fresh(str(output), {'template:index.html': 'a'})
+        assert not manifest.is_fresh(str(output), {'template:index.html': 'b'})
+
+        output.unlink()
+        assert not manifest.is_fresh(str(output), {'template:index.html': 'a'})
+
+    def test_changes(self, tmp_path):
+        """Ensure a full build reports its added and changed outputs, and the outputs it no longer produces as removed."""
+        manifest_path = str(tmp_path / 'manifest.json')
+        manifest = buildcache.BuildManifest(manifest_path, str(tmp_path))
+        manifest.produce(str(tmp_path / 'index.html'))
+        manifest.produce(str(tmp_path / 'old.html'))
+        manifest.save(full=True)
+
+        manifest = buildcache.BuildManifest(manifest_path, str(tmp_path))
+        manifest.produce(str(tmp_path / 'index.html'))
+        manifest.produce(str(tmp_path / 'new.html'))
+        assert manifest.changes(full=True) == {'added': ['new.html'], 'changed': ['index.html'], 'removed': ['old.html']}
+
+        manifest = buildcache.BuildManifest(manifest_path, str(tmp_path))
+        manifest.produce(str(tmp_path / 'index.html'), changed=False)
+        assert manifest.changes() == {'added': [], 'changed': [], 'removed': []}
+
+        manifest.remove(str(tmp_path / 'new.html'))
+        assert manifest.changes() == {'added': [], 'changed': [], 'removed': ['new.html']}
+
+
+class TestBytecodeCache:
+    def test_source_change_misses(self, tmp_path):
+        """Ensure the bytecode of a template is reused, unless its source changes."""
+        cache = buildcache.BytecodeCache(str(tmp_path), 1024 * 1024)
+        env = jinja2.Environment(loader=jinja2.DictLoader({}), bytecode_cache=cache)
+
+        bucket = cache.get_bucket(env, 'index.html', None, 'Hello {{ name }}')
+        assert bucket.code is None
+        bucket.code = compile('x = 1', 'index.html', 'exec')
+        cache.set_bucket(bucket)
+
+        assert cache.get_bucket(env, 'index.html', None, 'Hello {{ name }}').code is not None
+        assert cache.get_bucket(env, 'index.html', None, 'Hi {{ name }}').code is None
+
+    def test_evict(self, tmp_path):
+        """Ensure the least recently used entries are evicted once the cache is over its size cap."""
+        cache = buildcache.BytecodeCache(str(tmp_path), 1024 * 1024)
+        for i, size in enumerate([600, 300, 300]):
+            path = tmp_path / '{}.cache'.format(i)
+            path.write_bytes(b'x' * size * 1024)
+            os.utime(path, (i, i))
+
+        cache.max_size = 700 * 1024
+        cache.evict()
+
+        assert sorted(os.listdir(tmp_path)) == ['1.cache', '2.cache']
+
+
+class TestFileCache:
+    def test_evict(self, tmp_path):
+        """Ensure a size capped cache evicts the least recently stored or read artifacts once it's over the cap."""
+        cache = buildcache.FileCache(str(tmp_path), '.css', 1000)
+        for i in range(3):
+            cache.set(str(i), 'x' * 300)
+            os.utime(tmp_path / '{}.css'.format(i), (i, i))
+        assert cache.get('0') is not None
+
+        cache.set('3', 'x' * 300)
+        assert sorted(os.listdir(tmp_path)) == ['0.css', '2.css', '3.css'] and cache.get('1') is None
+
+
+class TestPublish:
+    def test_live_never_missing(self, tmp_path):
+        """Ensure the live path always points at a complete build while builds are published over it."""
+        live = str(tmp_path / 'site')
+        builds = []
+        for i in range(50):
+            build = tmp_path / 'site.build-{0}'.format(i)
+            build.mkdir()
+            (build / 'index.html').write_text(str(i))
+            builds.append(str(build))
+
+        missing = []
+        done = threading.Event()
+
+        def watch():
+            while not done.is_set():
+                if not os.path.exists(os.path.join(live, 'index.html')):
+                    missing.append(True)
+
+        buildcache.publish(builds[0], live)
+        watcher = threading.Thread(target=watch)
+        watcher.start()
+        try:
+            for previous, build in zip(builds, builds[1:]):
+                assert buildcache.publish(build, live) == previous
+        finally:
+            done.set()
+            watcher.join()
+
+        assert not missing
+        assert os.path.islink(live)
+        with open(os.path.join(live, 'index.html')) as f:
+            assert f.read() == '49'
+
+    def test_replace_directory(self, tmp_path):
+        """Ensure a live directory from before builds were published through a symlink is replaced by one."""
+        live = tmp_path / 'site'
+        live.mkdir()
+        (live / 'index.html').write_text('old')
+        build = tmp_path / 'site.build-1'
+        build.mkdir()
+        (build / 'index.html').write_text('new')
+
+        previous = buildcache.publish(str(build), str(live))
+        assert os.path.islink(live)
+        assert (live / 'index.html').read_text() == 'new'
+        with open(os.path.join(previous, 'index.html')) as f:
+            assert f.read() == 'old'
@@ -0,0 +1,26 @@
+import os
+
+import assets
+import builder
+import settings
+
+
+class TestSetupHttpd:
+    def test_after_build(self, tmp_path, monkeypatch):
+        """Ensure the --watch server still starts after a build has run its thread pools."""
+        monkeypatch.setattr(settings, 'BUILD_CACHE_PATH', str(tmp_path / 'cache'))
+        monkeypatch.setattr(assets, 'build_less_bundle', lambda filepaths, graph, cache: ('body {}', True))
+        searchpath = tmp_path / 'site'
+        (searchpath / '_media' / 'img').mkdir(parents=True)
+        (searchpath / '_media' / 'img' / 'logo.png').write_bytes(b'')
+        renderpath = str(tmp_path / 'dist')
+        site = builder.Site(['en-US'], str(searchpath), renderpath, {'base': [], 'site': []})
+        site.build_assets()
+        assert os.path.exists(os.path.join(renderpath, 'media', 'css', 'site.css'))
+
+        process = builder.setup_httpd(0, renderpath)
+        try:
+            assert process.is_alive()
+        finally:
+            process.terminate()
+            process.join()
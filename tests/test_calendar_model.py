@@ -2,6 +2,8 @@ import pytest
 import datetime
 from calgen.models.Calendar import Calendar, CalendarTypes
 
+import buildcache
+
 
 @pytest.fixture
 def calendar():
@@ -66,3 +68,13 @@ class TestCalendarModel:
         assert ievt.get('dtstart').dt == calendar.iso_date.date()
         day_after = sample_data.get('iso_date') + datetime.timedelta(days=1)
         assert ievt.get('dtend').dt == day_after.date()
+
+    def test_to_ics_timestamps(self, calendar, sample_data, monkeypatch):
+        """ Ensure the event timestamps are the build time, so identical inputs produce identical calendars """
+        build_time = datetime.datetime(2024, 1, 2, 3, 4, 5, tzinfo=datetime.UTC)
+        monkeypatch.setattr(buildcache, '_build_time', build_time)
+        calendar.from_api(sample_data)
+        ievt = calendar.to_ics()
+
+        assert ievt.get('last-modified').dt == build_time
+        assert ievt.get('dtstamp').dt == build_time
@@ -0,0 +1,15 @@
+import minify
+
+
+class TestMinifyHtml:
+    def test_collapses_whitespace_and_comments(self):
+        """Ensure whitespace is collapsed and comments are dropped, but conditional comments are kept."""
+        html = '<div>\n    <!-- a comment -->\n    <p>Hello   world</p>\n</div>\n<!--[if IE 9]>  <p>IE</p>  <![endif]-->'
+        assert minify.minify_html(html) == '<div>\n<p>Hello world</p>\n</div>\n<!--[if IE 9]>  <p>IE</p>  <![endif]-->'
+
+    def test_preserves_contents(self):
+        """Ensure pre, script and inline svg contents, attributes and non-breaking spaces are kept as they are."""
+        html = ('<pre>  a\n    b</pre>  <script>  if (a < b) {\n  }</script>\n'
+                '<svg  viewBox="0 0 1 1"> <text>  t  </text> </svg> <a title="x >  y">a\xa0\xa0b</a>')
+        assert minify.minify_html(html) == ('<pre>  a\n    b</pre> <script>  if (a < b) {\n  }</script>\n'
+                                            '<svg  viewBox="0 0 1 1"> <text>  t  </text> </svg> <a title="x >  y">a\xa0\xa0b</a>')
@@ -0,0 +1,30 @@
+import jinja2
+
+import profiling
+
+
+@jinja2.pass_context
+def greet(ctx, name):
+    return 'Hello {0} from {1}'.format(name, ctx['LANG'])
+
+
+class TestHelperProfiler:
+    def test_instrument(self):
+        """Ensure wrapped helpers still get their context, and calls are recorded by the template calling them."""
+        env = jinja2.Environment(loader=jinja2.DictLoader({'page.html': '{% include "inc.html" %} {{ "a"|upper }}',
+                                                           'inc.html': '{{ greet("you") }}'}))
+        env.globals['greet'] = greet
+        profiler = profiling.HelperProfiler()
+        profiler.instrument(env, ['greet'])
+        profiler.page = ('page.html', 'fr')
+
+        assert env.get_template('page.html').render(LANG='fr') == 'Hello you from fr A'
+        assert profiler.stats[('greet', 'inc.html', 'fr')][0] == 1
+        assert profiler.stats[('|upper', 'page.html', 'fr')][0] == 1
+
+    def test_ranked(self):
+        """Ensure stats are summed by the given fields and ranked by self time."""
+        stats = {('svg', 'a.html', 'en-US'): (2, 3.0, 1.0), ('svg', 'b.html', 'fr'): (1, 2.0, 2.0),
+                 ('url', 'a.html', 'en-US'): (5, 4.0, 0.5)}
+        assert profiling.ranked(stats, ('helper',)) == [(('svg',), 3, 5.0, 3.0), (('url',), 5, 4.0, 0.5)]
+        assert profiling.ranked(stats, ('helper', 'template'), 1) == [(('svg', 'b.html'), 1, 2.0, 2.0)]
@@ -0,0 +1,64 @@
+import os
+import re
+
+import redirectmap
+
+
+class TestRedirectMap:
+    def test_rewrite_map(self, tmp_path):
+        """Ensure redirects are keyed by their url path, and merged from other maps."""
+        root = str(tmp_path)
+        redirect_map = redirectmap.RedirectMap(root)
+        redirect_map.redirect(os.path.join(root, 'en-US', 'thunderbird', 'releases'), '/en-US/thunderbird/releasenotes/')
+        worker_map = redirectmap.RedirectMap(root)
+        worker_map.redirect(os.path.join(root, 'fr', 'download'), 'https://www.thunderbird.net/fr/')
+        redirect_map.update(*worker_map.pop())
+
+        assert not worker_map.redirects
+        assert redirect_map.rewrite_map() == ('/en-US/thunderbird/releases /en-US/thunderbird/releasenotes/\n'
+                                              '/fr/download https://www.thunderbird.net/fr/\n')
+
+    def test_nginx_not_found(self, tmp_path):
+        """Ensure the most specific 404 page comes first for nginx, and the root one is the default."""
+        root = str(tmp_path)
+        redirect_map = redirectmap.RedirectMap(root)
+        redirect_map.error_page(root, '/en-US/404.html')
+        redirect_map.error_page(os.path.join(root, 'fr'), '/fr/404.html')
+        redirect_map.error_page(os.path.join(root, 'en-US'), '/en-US/404.html')
+        conf = redirect_map.nginx_conf('site')
+
+        assert 'default "/en-US/404.html";' in conf
+        assert conf.index('"~^/en-US/"') < conf.index('"~^/fr/"') < conf.index('default "/en-US/404.html"')
+        assert '<Location "/fr">\n    ErrorDocument 404 /fr/404.html\n</Location>' in redirect_map.apache_conf()
+
+    def test_subpaths(self, tmp_path):
+        """Ensure redirects apply to everything under their directory, the most specific first, like the .htaccess files."""
+        root = str(tmp_path)
+        redirect_map = redirectmap.RedirectMap(root)
+        redirect_map.redirect(os.path.join(root, 'en-US', 'download'), '/en-US/thunderbird/all/')
+        redirect_map.redirect(os.path.join(root, 'en-US', 'download', 'beta'), '/en-US/thunderbird/all/?release=beta')
+
+        redirects = dict(line.split(' ', 1) for line in redirect_map.rewrite_map().splitlines())
+        nginx_rules = re.findall(r'"~(.*)" "(.*)";', redirect_map.nginx_conf('site'))
+        apache_rules = re.findall(r'RewriteCond "\$\{redirects:\$1\}" !=""\nRewriteRule "(.*)" "\$\{redirects:\$1\}" \[L\]',
+                                  redirect_map.apache_conf())
+
+        def nginx(uri):
+            for pattern, url in nginx_rules:
+                if re.match(pattern, uri):
+                    return url
+
+        def apache(uri):
+            for pattern in apache_rules:
+                match = re.match(pattern, uri)
+                if match and match.group(1) in redirects:
+                    return redirects[match.group(1)]
+
+        for server in (nginx, apache):
+            assert server('/en-US/download') == '/en-US/thunderbird/all/'
+            assert server('/en-US/download/index.html') == '/en-US/thunderbird/all/'
+            assert server('/en-US/download/linux/') == '/en-US/thunderbird/all/'
+            assert server('/en-US/download/beta/') == '/en-US/thunderbird/all/?release=beta'
+            assert server('/en-US/download/beta/linux/') == '/en-US/thunderbird/all/?release=beta'
+            assert server('/en-US/downloads/') is None
+            assert server('/en-US/downloadindex.html') is None
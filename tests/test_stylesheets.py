@@ -0,0 +1,47 @@
+import stylesheets
+import settings
+
+
+class TestPruneCss:
+    def test_prune_css(self, monkeypatch):
+        """Ensure only rules that can't match are removed, and at-rules are kept or pruned as a whole."""
+        monkeypatch.setattr(settings, 'CSS_PRUNE_ALLOWLIST', (r'is-\w+',))
+        css = ('/*! license */\n'
+               'a, .used:hover, .gone { color: red; }\n'
+               '.gone > .used { content: "}"; }\n'
+               '#main .used:not(.gone)::before { content: "{"; }\n'
+               '@media (max-width: 10px) { .gone { top: 0; } }\n'
+               '@media (min-width: 1px) { .used { top: 0; } .gone { top: 1px; } }\n'
+               '@keyframes spin { from { top: 0; } to { top: 1px; } }\n'
+               '.is-open, [class*="gone"] .used, .md\\:flex { top: 0; }\n')
+        pruned = stylesheets.prune_css(css, {'used', 'main', 'md:flex'})
+        assert pruned == ('/*! license */\n'
+                          'a, .used:hover{ color: red; }\n'
+                          '#main .used:not(.gone)::before { content: "{"; }\n'
+                          '@media (min-width: 1px) { .used { top: 0; } }\n'
+                          '@keyframes spin { from { top: 0; } to { top: 1px; } }\n'
+                          '.is-open, [class*="gone"] .used, .md\\:flex { top: 0; }\n')
+
+    def test_used_names(self):
+        """Ensure class names and ids are taken from the attributes, and words from inline scripts."""
+        html = '<div class="a  b" id=c data-class="d"><script>el.classList.add("is-open");</script></div>'
+        assert stylesheets.used_names(html) == {'a', 'b', 'c', 'el', 'classList', 'add', 'is-open'}
+
+
+class TestCriticalCss:
+    def test_critical_css(self):
+        """Ensure only the rules for what's above the fold are inlined, with urls relative to the page."""
+        css = '@import "fonts.css";\n.hero { background: url(../img/hero.png); }\n.footer { color: red; }\n'
+        html = ('<html><head><link href="/media/css/base-style.css" rel="stylesheet" type="text/css" /></head>'
+                '<body><div class="hero"></div>' + ' ' * 100 + '<div class="footer"></div></body></html>')
+
+        links = stylesheets.stylesheet_links(html, {'base-style'})
+        assert links == [('<link href="/media/css/base-style.css" rel="stylesheet" type="text/css" />',
+                          '/media/css/base-style.css', 'base-style')]
+        critical = stylesheets.rebase_urls(stylesheets.critical_css(css, html, 50), links[0][1])
+        assert critical == '.hero { background: url(/media/img/hero.png); }'
+
+        inlined = stylesheets.inline_critical_css(html, links, critical)
+        assert '<style>.hero { background: url(/media/img/hero.png); }</style>' in inlined
+        assert 'rel="stylesheet" type="text/css"' not in inlined
+        assert '<noscript><link rel="stylesheet" href="/media/css/base-style.css"></noscript>' in inlined
@@ -0,0 +1,46 @@
+import svgstore
+
+
+class TestOptimizeSvg:
+    def test_optimize_svg(self):
+        """Ensure editor data, comments and whitespace are removed, and path numbers are rounded."""
+        markup = ('<?xml version="1.0"?>\n<!-- Created with Inkscape -->\n'
+                  '<svg\n   inkscape:version="1.2" xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape"\n'
+                  '   viewBox="0 0 16 16">\n  <metadata><rdf:RDF/></metadata>\n  <sodipodi:namedview id="a" />\n'
+                  '  <path d="M1.23456 -0.00001L2.5.5" />\n</svg>\n')
+        assert svgstore.optimize_svg(markup, 2) == '<svg viewBox="0 0 16 16"><path d="M1.23 0L2.5.5"/></svg>'
+
+    def test_round_coordinates(self):
+        """Ensure a number rounded to an integer stays apart from a following number that starts with a dot."""
+        assert svgstore.round_coordinates('M1.0004.5 2.75,3e-5', 2) == 'M1 .5 2.75,3e-5'
+
+
+class TestSvgStore:
+    def test_invalidate(self, tmp_path):
+        """Ensure files are read once, and again once they're invalidated."""
+        icon = tmp_path / 'icons' / 'close.svg'
+        icon.parent.mkdir()
+        icon.write_text('<svg>a</svg>')
+        store = svgstore.SvgStore(str(tmp_path))
+        assert store.get('icons/close') == '<svg>a</svg>'
+
+        icon.write_text('<svg>b</svg>')
+        assert store.get('icons/close') == '<svg>a</svg>'
+        store.invalidate(str(tmp_path.parent / 'other.svg'))
+        assert store.get('icons/close') == '<svg>a</svg>'
+        store.invalidate(str(icon))
+        assert store.get('icons/close') == '<svg>b</svg>'
+
+    def test_symbols(self, tmp_path):
+        """Ensure a file inlined more than once in a page becomes a symbol, and a file inlined once is left alone."""
+        (tmp_path / 'check.svg').write_text('<svg class="icon" viewBox="0 0 8 8"><path d="M0 0"/></svg>')
+        (tmp_path / 'logo.svg').write_text('<svg viewBox="0 0 2 2"><circle r="1"/></svg>')
+        store = svgstore.SvgStore(str(tmp_path))
+        store.symbols = True
+        store.begin_page()
+        html = store.end_page('<p>{0}</p><p>{1}</p><p>{0}</p>'.format(store.inline('check'), store.inline('logo')))
+
+        assert html == ('<p><svg class="icon" viewBox="0 0 8 8"><symbol id="svg-symbol-check" viewBox="0 0 8 8">'
+                        '<path d="M0 0"/></symbol><use href="#svg-symbol-check"/></svg></p>'
+                        '<p><svg viewBox="0 0 2 2"><circle r="1"/></svg></p>'
+                        '<p><svg class="icon" viewBox="0 0 8 8"><use href="#svg-symbol-check"/></svg></p>')
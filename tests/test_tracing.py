@@ -0,0 +1,42 @@
+import json
+import os
+
+import tracing
+
+
+class TestTracer:
+    def test_write(self, tmp_path):
+        """Ensure spans are written as complete trace events, with the events collected from workers."""
+        tracer = tracing.Tracer()
+        with tracer.span('index.html', 'render', lang='en-US'):
+            pass
+        worker = tracing.Tracer()
+        with worker.span('fr', 'locale'):
+            pass
+        for event in worker.events:
+            event['pid'] = os.getpid() + 1
+        tracer.extend(worker.pop())
+
+        path = str(tmp_path / 'trace.json')
+        tracer.write(path)
+        with open(path) as f:
+            events = json.load(f)['traceEvents']
+
+        assert not worker.events
+        assert [e['args']['name'] for e in events if e['ph'] == 'M'] == ['build', 'worker 1']
+        spans = [e for e in events if e['ph'] == 'X']
+        assert [(e['name'], e['cat']) for e in spans] == [('index.html', 'render'), ('fr', 'locale')]
+        assert spans[0]['args'] == {'lang': 'en-US'}
+
+    def test_disabled(self):
+        """Ensure a disabled tracer records nothing."""
+        tracer = tracing.Tracer(False)
+        with tracer.span('index.html', 'render'):
+            pass
+        assert tracer.events == []
+
+    def test_slowest(self):
+        """Ensure spans of the same name are summed, and ranked by their total time."""
+        events = [{'name': 'a.html', 'cat': 'render', 'dur': 1e6}, {'name': 'b.html', 'cat': 'render', 'dur': 1.5e6},
+                  {'name': 'a.html', 'cat': 'render', 'dur': 1e6}, {'name': 'en-US', 'cat': 'locale', 'dur': 5e6}]
+        assert tracing.slowest(events, 'render') == [('a.html', 2, 2.0, 1.0), ('b.html', 1, 1.5, 1.5)]
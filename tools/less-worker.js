@@ -0,0 +1,40 @@
+/* Long-lived less compiler used by the build (see assets.LessWorker), so node and less are only started once.
+ *
+ * Usage: node less-worker.js [path to the less module]
+ *
+ * Reads one json request per line from stdin: {"filename": "/abs/path/file.less"}
+ * and writes one json response per line to stdout: {"css": "..."} or {"error": "..."}
+ */
+
+'use strict';
+
+const fs = require('fs');
+const path = require('path');
+const readline = require('readline');
+
+const less = require(process.argv[2] || 'less');
+
+// Requests are answered one at a time and in order, the build runs a worker per thread that compiles.
+let queue = Promise.resolve();
+
+function compile(filename) {
+  const input = fs.readFileSync(filename, 'utf8');
+  return less.render(input, {filename: filename, paths: [path.dirname(filename)]}).then(
+    (output) => ({css: output.css}),
+    (err) => ({error: less.formatError ? less.formatError(err) : String(err)})
+  );
+}
+
+readline.createInterface({input: process.stdin}).on('line', (line) => {
+  queue = queue.then(() => {
+    let request;
+    try {
+      request = JSON.parse(line);
+      return compile(request.filename);
+    } catch (err) {
+      return {error: String(err)};
+    }
+  }).then((response) => {
+    process.stdout.write(JSON.stringify(response) + '\n');
+  });
+});
@@ -0,0 +1,67 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+class Tracer(object):
+    """
+    Records how long the steps of a build take as spans in the Chrome trace event format, which chrome://tracing and
+    https://ui.perfetto.dev/ show as a timeline with a row per process and thread.
+    Timestamps are taken from the monotonic clock, which is shared by the forked worker processes, so the spans they
+    record line up with ours once collected with pop() and extend().
+    Parameters:
+        `enabled` (bool, optional): Record spans. When False span() does nothing, so it can be left in the build.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.events = []
+
+    @contextlib.contextmanager
+    def span(self, name, category, **args):
+        """Record the time spent in the with block as a span `name` of `category`, with `args` shown for it."""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            end = time.perf_counter_ns()
+            self.events.append({'name': name, 'cat': category, 'ph': 'X', 'ts': start / 1000, 'dur': (end - start) / 1000,
+                                'pid': os.getpid(), 'tid': threading.get_native_id(), 'args': args})
+
+    def pop(self):
+        """Return and clear the events recorded so far, used to collect them from worker processes."""
+        events, self.events = self.events, []
+        return events
+
+    def extend(self, events):
+        """Add `events` recorded elsewhere (e.g. a worker process)."""
+        self.events.extend(events)
+
+    def write(self, path):
+        """Write the events to the json file `path`, naming our process build and the others worker."""
+        pids = sorted({event['pid'] for event in self.events} - {os.getpid()})
+        names = [(os.getpid(), 'build')] + [(pid, 'worker {0}'.format(index + 1)) for index, pid in enumerate(pids)]
+        metadata = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': name}} for pid, name in names]
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': metadata + self.events, 'displayTimeUnit': 'ms'}, f)
+
+
+def slowest(events, category, limit=10):
+    """
+    Return the `limit` span names of `category` in `events` that took the longest in total, as (name, count, total
+    seconds, longest seconds) tuples.
+    """
+    totals = {}
+    for event in events:
+        if event.get('cat') == category:
+            count, total, longest = totals.get(event['name'], (0, 0, 0))
+            totals[event['name']] = (count + 1, total + event['dur'], max(longest, event['dur']))
+    ranked = sorted(totals.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+    return [(name, count, total / 1e6, longest / 1e6) for name, (count, total, longest) in ranked]
@@ -3,6 +3,7 @@
 from product_details import thunderbird_desktop as product_details
 from markupsafe import Markup
 
+import assets
 import gettext
 import os
 import re
@@ -38,16 +39,20 @@ def get_translations(self):
 
 def l10n_css(self):
     """Return locale-specific css for `self.locale` on the translation object."""
-    path = os.path.join(settings.MEDIA_URL.strip('/'), 'css', 'l10n', self.locale)
     markup = ''
-    if os.path.exists(path):
-        url = settings.MEDIA_URL + '/css/l10n/{0}/intl.css'.format(self.locale)
+    if assets.media.exists(os.path.join('css', 'l10n', self.locale)):
+        url = assets.url('css/l10n/{0}/intl.css'.format(self.locale))
         markup = ('<link rel="stylesheet" media="screen,projection,tv" href='
                   '"{0}">'.format(url))
 
     return Markup(markup)
 
 
+def catalog_path(lang):
+    """Return the path of the compiled gettext catalog used for `lang`, or None if there isn't one."""
+    return gettext.find("messages", localedir=settings.LOCALE_PATH, languages=[lang.replace('-', '_')])
+
+
 def gettext_object(lang):
     """Setup gettext translation object and add l10n_css and get_translations methods to it."""
     trans = gettext.translation("messages", localedir=settings.LOCALE_PATH, languages=[lang.replace('-', '_')], fallback=True)